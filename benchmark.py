@@ -0,0 +1,436 @@
+import cv2
+
+import time
+import json
+import argparse
+import inspect
+import os
+import platform
+import tempfile
+import threading
+import numpy as np
+
+from fotobudka import StripCompositor, MainWindow, CameraControl, FlashControl, PrinterControl, States, NullDisplay, \
+    make_preview_lut, render_preview, Layout, FramebufferDisplay, CameraModes, get_overlap
+from session_catalog import SessionCatalog
+
+
+SESSION_KEYS = ("click_to_countdown_s", "capture_latency_s", "shutter_lag_s", "flash_alignment",
+                "generate_output_image_s", "save_images_s", "images_saved_s", "session_to_print_s")
+
+
+def legacy_compose(frames, output_image_background, print_background, print_image_size, cropped_img_start,
+                   cropped_img_end, small_img_size, small_img_positions):
+    output_image = output_image_background.copy()
+
+    for frame, (x, y) in zip(frames, small_img_positions):
+        cropped = frame[cropped_img_start[1]:cropped_img_end[1], cropped_img_start[0]:cropped_img_end[0]]
+        small = cv2.resize(cropped, tuple(small_img_size))
+        output_image[y:y + small_img_size[1], x:x + small_img_size[0]] = small
+
+    print_image = print_background.copy()
+    print_image[0:print_image_size[1], 0:int(print_image_size[0] / 2)] = output_image
+    return output_image, print_image
+
+
+def measure(function, sessions):
+    times = []
+    for _ in range(sessions):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+
+    times.sort()
+    return {"mean_ms": sum(times) / len(times), "median_ms": times[len(times) // 2], "max_ms": times[-1]}
+
+
+def benchmark_compose(data, sessions):
+    camera = data["camera"]
+    window = data["main_window"]
+
+    output_image_background = cv2.resize(cv2.imread(window["output_image_background_filename"]),
+                                         window["output_image_size"])
+    print_background = cv2.resize(cv2.imread(window["print_background_filename"]), window["print_image_size"])
+    positions = [window["small_img_1_pos"], window["small_img_2_pos"], window["small_img_3_pos"]]
+
+    frames = [np.random.randint(0, 256, (camera["size"][1], camera["size"][0], 3), np.uint8) for _ in range(3)]
+
+    compositor = StripCompositor(output_image_background, print_background, Layout.from_config(data))
+
+    legacy = measure(lambda: legacy_compose(frames, output_image_background, print_background,
+                                            window["print_image_size"], window["cropped_img_start"],
+                                            window["cropped_img_end"], window["small_img_size"], positions), sessions)
+    compiled = measure(lambda: compositor.compose(frames), sessions)
+
+    expected = legacy_compose(frames, output_image_background, print_background, window["print_image_size"],
+                              window["cropped_img_start"], window["cropped_img_end"], window["small_img_size"],
+                              positions)[1]
+    identical = bool(np.array_equal(compositor.compose(frames)[1], expected))
+
+    return {"sessions": sessions, "legacy": legacy, "compiled": compiled, "identical_output": identical}
+
+
+def legacy_preview(image, size, contrast, brightness):
+    preview = cv2.resize(image, tuple(size))
+    return cv2.addWeighted(preview, contrast, np.zeros(preview.shape, preview.dtype), 0, brightness)
+
+
+def benchmark_preview(data, sessions):
+    camera = data["camera"]
+    window = data["main_window"]
+    contrast = window["preview_contrast_value"]
+    brightness = window["preview_brightness_value"]
+
+    frame = np.random.randint(0, 256, (camera["size"][1], camera["size"][0], 3), np.uint8)
+    size = window["frame_preview_size"]
+    lut = make_preview_lut(contrast, brightness)
+    dst = np.empty((size[1], size[0], 3), np.uint8)
+
+    legacy = measure(lambda: legacy_preview(frame, size, contrast, brightness), sessions)
+    fused = measure(lambda: render_preview(frame, size, lut, dst), sessions)
+
+    # the whole value range, not only what the random frame happens to hit
+    values = np.arange(256, dtype=np.uint8).reshape(16, 16, 1).repeat(3, axis=2)
+    identical = bool(np.array_equal(legacy_preview(frame, size, contrast, brightness),
+                                    render_preview(frame, size, lut, dst))) and \
+        bool(np.array_equal(legacy_preview(values, (16, 16), contrast, brightness),
+                            render_preview(values, (16, 16), lut)))
+
+    return {"sessions": sessions, "legacy": legacy, "fused": fused, "identical_output": identical}
+
+
+# checks fail with an AssertionError and a non zero exit code, they need no camera, flash or screen
+def check_framebuffer_display():
+    with tempfile.TemporaryDirectory() as path:
+        device = os.path.join(path, "fb0")
+
+        # without the geometry the path has to be a real framebuffer, a mistyped one is not created
+        for size, bits_per_pixel in ((None, None), ((8, 4), None), (None, 32)):
+            try:
+                FramebufferDisplay(device, size=size, bits_per_pixel=bits_per_pixel)
+            except OSError:
+                pass
+            else:
+                raise AssertionError("framebuffer opened without its geometry")
+            assert not os.path.exists(device), "framebuffer file created without its geometry"
+
+        for bits_per_pixel, expected in ((32, (10, 20, 30, 255)), (24, (10, 20, 30))):
+            display = FramebufferDisplay(device, size=(8, 4), bits_per_pixel=bits_per_pixel)
+            frame = np.empty((4, 8, 3), np.uint8)
+            frame[:] = (10, 20, 30)
+            display.show(frame)
+            display.close()
+
+            with open(device, "rb") as f:
+                screen = np.frombuffer(f.read(), np.uint8)
+            os.remove(device)
+            assert screen.size == 8 * 4 * bits_per_pixel // 8, "framebuffer file has the wrong size"
+            assert (screen.reshape(4, 8, -1) == expected).all(), "frame not written to the framebuffer file"
+
+
+def check_flash_capture(photos=3):
+    # simulated camera and flash: a frame is as bright as the part of its exposure the flash pulse covered
+    flash_control = FlashControl(disable_flash=True, sleep_before_flash=0.01, pulse_time=0.05)
+    camera_control = CameraControl(flash_control, frame_rate=10, exposure_time=100000, size=(64, 36),
+                                   disable_camera=True, frame_ring_size=4)
+    try:
+        assert camera_control.ready.wait(10), "simulated camera did not start"
+        camera_control.set_mode(CameraModes.WARM)
+        time.sleep(0.5)
+        frame_duration = camera_control.picam2.frame_duration_ns
+        exposure = camera_control.picam2.exposure_time * 1000
+
+        for _ in range(photos):
+            request = camera_control.start_photo()
+            request.result(10)
+            pulse = flash_control.get_pulse(request.request_time_ns)
+            assert pulse is not None, "flash did not fire"
+
+            start = request.info["sensor_timestamp"]
+            overlap = get_overlap(start, start + exposure, pulse)
+            assert overlap > 0, "photo taken outside of the flash"
+            # the frames right before and after the photo were in the ring too
+            for neighbour in (start - frame_duration, start + frame_duration):
+                assert overlap >= get_overlap(neighbour, neighbour + exposure, pulse), "a better lit frame was skipped"
+            assert request.info["flash_alignment"] == round(overlap / (pulse[1] - pulse[0]), 3)
+            # exposures follow each other without a gap, one of the two frames the pulse falls in has half of it
+            assert request.info["flash_alignment"] >= 0.5, "flash split badly between frames"
+            # the photo buffer holds the chosen frame, not another one from the ring
+            assert request.frame[0, 0, 0] == int(255 * min(overlap / exposure, 1.0)), "wrong frame copied"
+
+            camera_control.frame_pool.release(request.buffer_id)
+            request = None
+            time.sleep(0.3)
+    finally:
+        camera_control.set_mode(CameraModes.IDLE)
+        camera_control.close()
+        flash_control.close()
+
+
+def run_checks():
+    checks = {"framebuffer_display": check_framebuffer_display, "flash_capture": check_flash_capture}
+    for name, check in checks.items():
+        check()
+        print("  {:<24} ok".format(name))
+    return list(checks)
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {"mean": sum(values) / len(values), "median": values[len(values) // 2], "max": values[-1]}
+
+
+def get_machine_info():
+    info = {"platform": platform.platform(), "machine": platform.machine(), "python": platform.python_version(),
+            "opencv": cv2.__version__, "cpu_count": os.cpu_count()}
+    try:
+        with open("/proc/device-tree/model") as f:
+            info["model"] = f.read().strip("\x00\n")
+    except OSError:
+        pass
+    return info
+
+
+class SessionProbe:
+    def __init__(self, main_window: MainWindow, camera_control: CameraControl, printer_control: PrinterControl):
+        self.lock = threading.Lock()
+        self.events = []
+
+        main_window.handle_countdown = self.wrap("countdown_frame", main_window.handle_countdown)
+        main_window.generate_output_image = self.wrap_timed("generate_output_image",
+                                                            main_window.generate_output_image)
+        main_window.save_images = self.wrap_timed("save_images", main_window.save_images)
+        main_window.on_images_saved = self.wrap("images_saved", main_window.on_images_saved)
+        camera_control.start_photo = self.wrap_start_photo(camera_control.start_photo)
+        printer_control.add = self.wrap("print_submitted", printer_control.add)
+
+    def record(self, name, start, duration=None):
+        with self.lock:
+            self.events.append((name, start, duration))
+
+    def wrap(self, name, function):
+        def wrapper(*args, **kwargs):
+            self.record(name, time.perf_counter())
+            return function(*args, **kwargs)
+        return wrapper
+
+    def wrap_timed(self, name, function):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            self.record(name, start, time.perf_counter() - start)
+            return result
+        return wrapper
+
+    def wrap_start_photo(self, function):
+        def wrapper(*args, **kwargs):
+            self.record("start_photo", time.perf_counter())
+            request = function(*args, **kwargs)
+            request.add_done_callback(self.on_photo_done)
+            return request
+        return wrapper
+
+    def on_photo_done(self, request):
+        now = time.perf_counter()
+        self.record("photo_done", now)
+        if request.exception is not None:
+            return
+        self.record("shutter_lag", now, request.info["shutter_lag_ms"] / 1000)
+        self.record("flash_alignment", now, request.info["flash_alignment"])
+
+    def take(self):
+        with self.lock:
+            events = self.events
+            self.events = []
+        return events
+
+
+def wait_for_state(main_window, states, timeout):
+    deadline = time.perf_counter() + timeout
+    while main_window.current_state not in states:
+        if time.perf_counter() > deadline:
+            raise TimeoutError("Main window stuck in state " + main_window.current_state.name)
+        time.sleep(0.002)
+    return time.perf_counter()
+
+
+def make_main_window(data, camera_control, flash_control, printer_control, cache_path):
+    window = dict(data["main_window"])
+    window["default_how_many_prints"] = data["printer"]["default_how_many_prints"]
+    window["max_prints"] = data["printer"]["max_prints"]
+    window["save_path"] = os.path.join(cache_path, "saved_images")
+    window["frame_cache_path"] = os.path.join(cache_path, "frame_cache")
+    window["metrics_path"] = ""
+    window["session_catalog_path"] = os.path.join(cache_path, "saved_images", "sessions.db")
+    window["display"] = NullDisplay()
+    window["layout"] = Layout.from_config(data)
+
+    parameters = inspect.signature(MainWindow).parameters
+    kwargs = {key: value for key, value in window.items() if key in parameters}
+    return MainWindow(camera_control, flash_control, printer_control, **kwargs)
+
+
+def benchmark_sessions(data, sessions, fake_print_time, timeout=120.0):
+    flash_control = FlashControl(gpio_pin=data["flash"]["gpio_pin"],
+                                 sleep_before_flash=data["flash"]["sleep_before_flash"], disable_flash=True)
+    camera_control = CameraControl(flash_control, frame_rate=data["camera"]["frame_rate"],
+                                   exposure_time=data["camera"]["exposure_time"], size=data["camera"]["size"],
+                                   disable_camera=True)
+    printer_control = PrinterControl(wait_for_print=data["printer"]["wait_for_print"], disable_printer=True,
+                                     job_poll_interval=0.05, fake_print_time=fake_print_time)
+
+    results = {"config": {"fps": data["main_window"]["fps"],
+                          "frame_preview_timeout": data["main_window"]["frame_preview_timeout"],
+                          "use_frame_cache": data["main_window"].get("use_frame_cache", False),
+                          "stream_videos": data["main_window"].get("stream_videos", False),
+                          "fake_print_time": fake_print_time}}
+
+    with tempfile.TemporaryDirectory() as cache_path:
+        start = time.perf_counter()
+        main_window = make_main_window(data, camera_control, flash_control, printer_control, cache_path)
+        results["cold_start_s"] = time.perf_counter() - start
+        main_window.close()
+
+        start = time.perf_counter()
+        main_window = make_main_window(data, camera_control, flash_control, printer_control, cache_path)
+        results["warm_start_s"] = time.perf_counter() - start
+
+        camera_control.ready.wait(timeout)
+        probe = SessionProbe(main_window, camera_control, printer_control)
+        thread = threading.Thread(target=main_window.run)
+        thread.start()
+
+        session_results = []
+        try:
+            for _ in range(sessions):
+                wait_for_state(main_window, (States.HOME,), timeout)
+                probe.take()
+
+                click_time = time.perf_counter()
+                main_window.button_click()
+                wait_for_state(main_window, (States.CONFIRM_PRINT,), timeout)
+                main_window.button_click()
+                wait_for_state(main_window, (States.PRINT,), timeout)
+                wait_for_state(main_window, (States.HOME,), timeout)
+
+                events = probe.take()
+                session_results.append(analyze_session(click_time, events))
+        finally:
+            main_window.end.set()
+            thread.join()
+            main_window.close()
+            camera_control.close()
+            flash_control.close()
+            printer_control.close()
+
+        results["frame_metrics"] = main_window.frame_metrics.snapshot()
+
+        catalog = SessionCatalog(os.path.join(cache_path, "saved_images", "sessions.db"), background=False)
+        results["session_catalog"] = catalog.get_stats()
+        catalog.close()
+
+    results["sessions"] = session_results
+    for key in SESSION_KEYS:
+        values = []
+        for session in session_results:
+            value = session[key]
+            values.extend(value if isinstance(value, list) else [value])
+        results[key] = summarize([value for value in values if value is not None])
+
+    return results
+
+
+def analyze_session(click_time, events):
+    first = {}
+    durations = {}
+    photo_starts = []
+    capture_latencies = []
+    shutter_lags = []
+    flash_alignments = []
+
+    for name, start, duration in events:
+        first.setdefault(name, start)
+        if duration is not None:
+            durations[name] = duration
+        if name == "start_photo":
+            photo_starts.append(start)
+        elif name == "photo_done" and photo_starts:
+            capture_latencies.append(start - photo_starts[-1])
+        elif name == "shutter_lag":
+            shutter_lags.append(duration)
+        elif name == "flash_alignment":
+            flash_alignments.append(duration)
+
+    def since_click(name):
+        return first[name] - click_time if name in first else None
+
+    return {"click_to_countdown_s": since_click("countdown_frame"),
+            "capture_latency_s": capture_latencies,
+            "shutter_lag_s": shutter_lags,
+            "flash_alignment": flash_alignments,
+            "generate_output_image_s": durations.get("generate_output_image"),
+            "save_images_s": durations.get("save_images"),
+            "images_saved_s": since_click("images_saved"),
+            "session_to_print_s": since_click("print_submitted")}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fotobudka benchmark',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-c', '--config', help='json config file path', default='raspi_global_paths.json', type=str)
+    parser.add_argument('-s', '--sessions', help='number of sessions to measure', default=50, type=int)
+    parser.add_argument('-b', '--benchmark', help='which benchmark to run', default='all',
+                        choices=['all', 'compose', 'preview', 'session', 'check'])
+    parser.add_argument('--session-count', help='number of full headless booth sessions', default=3, type=int)
+    parser.add_argument('--fake-print-time', help='seconds per copy of the fake printer', default=0.5, type=float)
+    parser.add_argument('-o', '--output', help='write results to this json file', default='', type=str)
+    args = parser.parse_args()
+
+    f = open(args.config)
+    data = json.load(f)
+    f.close()
+
+    results = {"machine": get_machine_info(), "config_file": args.config, "time": time.time()}
+
+    if args.benchmark in ("all", "compose"):
+        results["compose"] = benchmark_compose(data, args.sessions)
+        print("compose:")
+        for variant in ("legacy", "compiled"):
+            print("  {:<9} mean {:7.2f} ms  median {:7.2f} ms  max {:7.2f} ms".format(
+                variant, results["compose"][variant]["mean_ms"], results["compose"][variant]["median_ms"],
+                results["compose"][variant]["max_ms"]))
+        print("  identical output:", results["compose"]["identical_output"])
+
+    if args.benchmark in ("all", "preview"):
+        results["preview"] = benchmark_preview(data, args.sessions)
+        print("preview:")
+        for variant in ("legacy", "fused"):
+            print("  {:<9} mean {:7.2f} ms  median {:7.2f} ms  max {:7.2f} ms".format(
+                variant, results["preview"][variant]["mean_ms"], results["preview"][variant]["median_ms"],
+                results["preview"][variant]["max_ms"]))
+        print("  identical output:", results["preview"]["identical_output"])
+
+    if args.benchmark in ("all", "session"):
+        results["session"] = benchmark_sessions(data, args.session_count, args.fake_print_time)
+        print("session:")
+        print("  {:<24} {:8.3f} s".format("cold_start", results["session"]["cold_start_s"]))
+        print("  {:<24} {:8.3f} s".format("warm_start", results["session"]["warm_start_s"]))
+        for key in SESSION_KEYS:
+            value = results["session"][key]
+            if value is not None:
+                name, unit = (key[:-2], "s") if key.endswith("_s") else (key, " ")
+                print("  {:<24} mean {:8.3f} {}  median {:8.3f} {}  max {:8.3f} {}".format(
+                    name, value["mean"], unit, value["median"], unit, value["max"], unit))
+        catalog = results["session"]["session_catalog"]
+        print("  {:<24} {} saved, {} failed, {}/{} prints".format(
+            "session_catalog", catalog["saved"], catalog["failed"], catalog["printed"], catalog["prints"]))
+
+    if args.benchmark == "check":
+        print("check:")
+        results["check"] = run_checks()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,74 @@
+import threading
+import time
+from enum import IntEnum
+
+
+class JobState(IntEnum):
+    PENDING = 3
+    HELD = 4
+    PROCESSING = 5
+    STOPPED = 6
+    CANCELED = 7
+    ABORTED = 8
+    COMPLETED = 9
+
+
+FINISHED_JOB_STATES = (JobState.CANCELED, JobState.ABORTED, JobState.COMPLETED)
+
+
+def get_job_attributes(conn, job_id):
+    return conn.getJobAttributes(job_id, requested_attributes=["job-state", "job-media-sheets-completed"])
+
+
+# stand-in for cups.Connection, jobs move through the CUPS states on a timer
+class FakeConnection:
+    def __init__(self, printer_name="fake_printer", pending_time=0.5, print_time=3.0, abort_files=()):
+        self.printer_name = printer_name
+        self.pending_time = pending_time
+        self.print_time = print_time
+        self.abort_files = abort_files
+
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.next_job_id = 1
+
+    def getPrinters(self):
+        return {self.printer_name: {"printer-info": "Fake printer", "printer-state": 3}}
+
+    def printFile(self, printer, filename, title, options):
+        with self.lock:
+            job_id = self.next_job_id
+            self.next_job_id += 1
+            self.jobs[job_id] = {"printer": printer, "filename": filename, "title": title, "options": dict(options),
+                                 "created": time.monotonic(), "canceled": False}
+        return job_id
+
+    def cancelJob(self, job_id, purge_job=False):
+        with self.lock:
+            self.jobs[job_id]["canceled"] = True
+
+    def getJobAttributes(self, job_id, requested_attributes=None):
+        with self.lock:
+            job = self.jobs[job_id]
+
+        copies = int(job["options"].get("copies", 1))
+        elapsed = time.monotonic() - job["created"]
+        printing_time = elapsed - self.pending_time
+        sheets_completed = min(max(int(printing_time / self.print_time), 0), copies)
+
+        if job["canceled"]:
+            state = JobState.CANCELED
+        elif printing_time < 0:
+            state = JobState.PENDING
+        elif job["filename"] in self.abort_files:
+            state = JobState.ABORTED
+        elif sheets_completed < copies:
+            state = JobState.PROCESSING
+        else:
+            state = JobState.COMPLETED
+
+        attributes = {"job-id": job_id, "job-state": int(state), "job-media-sheets-completed": sheets_completed,
+                      "job-name": job["title"], "copies": copies}
+        if requested_attributes is not None:
+            attributes = {key: value for key, value in attributes.items() if key in requested_attributes}
+        return attributes
@@ -6,47 +6,287 @@ from enum import IntEnum
 import numpy as np
 from PIL import ImageFont, ImageDraw, Image
 import random
-import cups
-from queue import Queue
+from queue import Queue, Empty, Full
+from collections import deque, OrderedDict
 import os
 from datetime import datetime
 import json
 import argparse
+import atexit
 import traceback
+import hashlib
+import math
+import mmap
+import select
+import stat
+import struct
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from cups_jobs import JobState, FINISHED_JOB_STATES, FakeConnection, get_job_attributes
+from session_catalog import SessionCatalog
+from thumbnails import ThumbnailWriter
+
+
+class FrameScheduler:
+    def __init__(self, rate):
+        self.period = 1.0 / rate
+        self.next_deadline = time.monotonic() + self.period
+        self.lateness = 0.0
+        self.dropped_frames = 0
 
+    def get_remaining_time(self):
+        return self.next_deadline - time.monotonic()
 
-class Rate:
-    def __init__(self, rate):
-        self.rate_time = 1.0 / rate
-        self.last_time = time.time()
+    def get_remaining_millis(self):
+        # rounded up so the wait never ends before the deadline, at least 1 because waitKey(0) blocks forever
+        return max(math.ceil(self.get_remaining_time() * 1000), 1)
 
     def sleep(self):
-        time_diff = time.time() - self.last_time
-        sleep_time = self.rate_time - time_diff
+        sleep_time = self.get_remaining_time()
         if sleep_time > 0:
             time.sleep(sleep_time)
+        self.tick()
 
-        self.last_time = time.time()
+    def tick(self):
+        now = time.monotonic()
+        self.lateness = max(now - self.next_deadline, 0.0)
+        self.dropped_frames = 0
 
-    def get_remaining_time_millis_cv2(self):
-        time_diff = time.time() - self.last_time
-        sleep_time = self.rate_time - time_diff
-        sleep_time = int(sleep_time * 1000)
-        if sleep_time > 0:
-            return sleep_time
+        if now < self.next_deadline:
+            # woken early (a key press), the deadline stays where it was
+            return
+
+        # deadlines stay on a fixed grid, frames that could not make it in time are dropped instead of
+        # pushing every following frame back
+        self.dropped_frames = int(self.lateness / self.period)
+        self.next_deadline += (self.dropped_frames + 1) * self.period
+
+    def restart(self):
+        self.next_deadline = time.monotonic() + self.period
+        self.lateness = 0.0
+        self.dropped_frames = 0
+
+
+class OpenCVDisplay:
+    def __init__(self, fullscreen=True):
+        _ = cv2.namedWindow("window", cv2.WND_PROP_FULLSCREEN)
+        if fullscreen:
+            cv2.moveWindow("window", 0, 0)
+            cv2.setWindowProperty("window", cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+
+    def show(self, frame):
+        cv2.imshow("window", frame)
+
+    def wait_key(self, millis):
+        return cv2.waitKey(millis)
+
+    def close(self):
+        cv2.destroyWindow("window")
+
+
+class NullDisplay:
+    def __init__(self):
+        self.frames_shown = 0
+
+    def show(self, frame):
+        self.frames_shown += 1
+
+    def wait_key(self, millis):
+        time.sleep(millis / 1000)
+        return -1
+
+    def close(self):
+        pass
+
+
+class FramebufferDisplay:
+    EV_KEY = 1
+    KEYS = {16: ord("q"), 57: ord(" "), 115: ord(" ")}  # KEY_Q, KEY_SPACE, KEY_VOLUMEUP
+    INPUT_EVENT = struct.Struct("llHHi")
+    ROTATIONS = {90: cv2.ROTATE_90_CLOCKWISE, 180: cv2.ROTATE_180, 270: cv2.ROTATE_90_COUNTERCLOCKWISE}
+
+    def __init__(self, device="/dev/fb0", input_device="", size=None, bits_per_pixel=None, rotation=0):
+        # geometry comes from sysfs for a real framebuffer, a plain file (for tests) needs it passed in and is
+        # only created then, a mistyped device path is an error instead of a new file
+        file_backed = size is not None and bits_per_pixel is not None
+        sysfs_path = os.path.join("/sys/class/graphics", os.path.basename(device))
+        if size is None:
+            with open(os.path.join(sysfs_path, "virtual_size")) as f:
+                size = [int(value) for value in f.read().strip().split(",")]
+        if bits_per_pixel is None:
+            with open(os.path.join(sysfs_path, "bits_per_pixel")) as f:
+                bits_per_pixel = int(f.read().strip())
+
+        self.width, self.height = int(size[0]), int(size[1])
+        self.bytes_per_pixel = bits_per_pixel // 8
+        if self.bytes_per_pixel not in (2, 3, 4):
+            raise ValueError("Unsupported framebuffer depth: " + str(bits_per_pixel))
+
+        stride = self.width * self.bytes_per_pixel
+        if os.path.exists(os.path.join(sysfs_path, "stride")):
+            with open(os.path.join(sysfs_path, "stride")) as f:
+                stride = int(f.read().strip())
+
+        self.fd = os.open(device, (os.O_RDWR | os.O_CREAT) if file_backed else os.O_RDWR)
+        length = stride * self.height
+        if file_backed and stat.S_ISREG(os.fstat(self.fd).st_mode) and os.fstat(self.fd).st_size < length:
+            os.truncate(self.fd, length)
+        self.mmap = mmap.mmap(self.fd, length)
+
+        buffer = np.frombuffer(self.mmap, np.uint8).reshape((self.height, stride))
+        self.screen = buffer[:, :self.width * self.bytes_per_pixel].reshape((self.height, self.width,
+                                                                             self.bytes_per_pixel))
+        self.rotation = self.ROTATIONS.get(rotation)
+        self.rotated = None
+
+        self.input_fd = None
+        if input_device:
+            self.input_fd = os.open(input_device, os.O_RDONLY | os.O_NONBLOCK)
+
+    def show(self, frame):
+        if self.rotation is not None:
+            shape = (frame.shape[1], frame.shape[0], 3) if self.rotation != cv2.ROTATE_180 else frame.shape
+            if self.rotated is None or self.rotated.shape != shape:
+                self.rotated = np.empty(shape, np.uint8)
+            cv2.rotate(frame, self.rotation, dst=self.rotated)
+            frame = self.rotated
+
+        h = min(frame.shape[0], self.height)
+        w = min(frame.shape[1], self.width)
+        frame = frame[:h, :w]
+        screen = self.screen[:h, :w]
+
+        if self.bytes_per_pixel == 4:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA, dst=screen)
+        elif self.bytes_per_pixel == 2:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2BGR565, dst=screen)
         else:
-            return 1
+            screen[:] = frame
+
+    def wait_key(self, millis):
+        if self.input_fd is None:
+            time.sleep(millis / 1000)
+            return -1
+
+        readable, _, _ = select.select([self.input_fd], [], [], millis / 1000)
+        if not readable:
+            return -1
+
+        key = -1
+        try:
+            data = os.read(self.input_fd, self.INPUT_EVENT.size * 64)
+        except BlockingIOError:
+            return -1
+        for offset in range(0, len(data) - self.INPUT_EVENT.size + 1, self.INPUT_EVENT.size):
+            _, _, event_type, code, value = self.INPUT_EVENT.unpack_from(data, offset)
+            if event_type == self.EV_KEY and value == 1 and code in self.KEYS and key == -1:
+                key = self.KEYS[code]
+        return key
+
+    def close(self):
+        self.screen = None
+        self.mmap.close()
+        os.close(self.fd)
+        if self.input_fd is not None:
+            os.close(self.input_fd)
+
+
+# startup steps run at the same time, this keeps when each of them started and got ready
+class BootReport:
+    def __init__(self, report_timeout=60.0):
+        self.start_time = time.perf_counter()
+        self.report_timeout = report_timeout
+        self.lock = threading.Lock()
+        self.steps = OrderedDict()
+        self.components = {}
+        self.end = threading.Event()
+
+    def begin(self, name):
+        with self.lock:
+            self.steps[name] = [time.perf_counter(), None]
 
-    def update_last_time(self):
-        self.last_time = time.time()
+    def done(self, name, end_time=None):
+        with self.lock:
+            self.steps[name][1] = time.perf_counter() if end_time is None else end_time
+
+    def watch(self, name, component):
+        # the component finishes its setup in its own thread, it sets ready and ready_time when done
+        self.components[name] = component
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.start()
+
+    def run(self):
+        deadline = time.perf_counter() + self.report_timeout
+        while not self.end.is_set() and time.perf_counter() < deadline:
+            # a failed setup may still be retried, the report does not wait for it
+            if all(component.ready.is_set() or component.setup_error is not None
+                   for component in self.components.values()):
+                break
+            self.end.wait(0.1)
+
+        for name, component in self.components.items():
+            if component.ready.is_set():
+                self.done(name, component.ready_time)
+        print(self.get_report())
+
+    def get_report(self):
+        lines = ["Boot timing:"]
+        last_end = self.start_time
+        with self.lock:
+            for name, (start, end) in self.steps.items():
+                component = self.components.get(name)
+                if end is None and component is not None and component.setup_error is not None:
+                    lines.append("  {:<12} start {:6.2f} s  failed: {}".format(name, start - self.start_time,
+                                                                              component.setup_error))
+                elif end is None:
+                    lines.append("  {:<12} start {:6.2f} s  not ready".format(name, start - self.start_time))
+                else:
+                    lines.append("  {:<12} start {:6.2f} s  ready {:6.2f} s  took {:6.2f} s".format(
+                        name, start - self.start_time, end - self.start_time, end - start))
+                    last_end = max(last_end, end)
+        lines.append("  {:<12} {:6.2f} s".format("total", last_end - self.start_time))
+        return "\n".join(lines)
+
+    def close(self):
+        self.end.set()
+
+
+def create_display(display_backend="opencv", fullscreen=True, framebuffer_device="/dev/fb0", input_device="",
+                   framebuffer_rotation=0):
+    if display_backend == "opencv":
+        return OpenCVDisplay(fullscreen)
+    elif display_backend == "framebuffer":
+        return FramebufferDisplay(framebuffer_device, input_device, rotation=framebuffer_rotation)
+    elif display_backend == "null":
+        return NullDisplay()
+    else:
+        print("Wrong display backend: " + display_backend + " Available backends: opencv, framebuffer, null")
+        exit(0)
+
+
+def sensor_clock_ns():
+    # libcamera sensor timestamps count from boot, CLOCK_BOOTTIME is only there on linux
+    if hasattr(time, "CLOCK_BOOTTIME"):
+        return time.clock_gettime_ns(time.CLOCK_BOOTTIME)
+    return time.monotonic_ns()
 
 
 class FlashControl:
-    def __init__(self, gpio_pin=22, sleep_before_flash=0.01, disable_flash=False):
+    def __init__(self, gpio_pin=22, sleep_before_flash=0.01, disable_flash=False, pulse_time=0.1):
         self.flash_event = threading.Event()
         self.end = threading.Event()
         self.sleep_before_flash = sleep_before_flash
+        self.pulse_time = pulse_time
+        self.pulses = deque(maxlen=16)
+        self.pulses_lock = threading.Lock()
         self.disable_flash = disable_flash
+        self.ready = threading.Event()
+        self.ready_time = None
+        self.setup_error = None
         if not self.disable_flash:
 
             self.gpio_pin = gpio_pin
@@ -56,12 +296,6 @@ class FlashControl:
 
             GPIO.output(self.gpio_pin, GPIO.HIGH)
 
-            for _ in range(3):
-                GPIO.output(self.gpio_pin, GPIO.LOW)
-                time.sleep(0.1)
-                GPIO.output(self.gpio_pin, GPIO.HIGH)
-                time.sleep(0.5)
-
         thread = threading.Thread(target=self.run)
         thread.start()
 
@@ -70,22 +304,60 @@ class FlashControl:
     def start_flash(self):
         self.flash_event.set()
 
+    def get_pulse(self, after_ns):
+        with self.pulses_lock:
+            for pulse in self.pulses:
+                if pulse[0] >= after_ns:
+                    return pulse
+        return None
+
+    def get_pulses(self):
+        with self.pulses_lock:
+            return list(self.pulses)
+
+    def self_test(self):
+        # three blinks at startup, done in the flash thread so the rest of the booth does not wait for them
+        if not self.disable_flash:
+            for _ in range(3):
+                GPIO.output(self.gpio_pin, GPIO.LOW)
+                time.sleep(0.1)
+                GPIO.output(self.gpio_pin, GPIO.HIGH)
+                time.sleep(0.5)
+
+        self.ready_time = time.perf_counter()
+        self.ready.set()
+
     def run(self):
-        rate = Rate(100)
+        try:
+            self.self_test()
+        except Exception as e:
+            print("Flash self test exception occurred: ", str(e))
+            traceback.print_exc()
+            self.setup_error = str(e)
 
         while not self.end.is_set():
             try:
-                if self.flash_event.is_set():
+                # close sets the event only to wake this thread, the flash must not go off then
+                if self.flash_event.wait(0.1) and not self.end.is_set():
                     self.flash_event.clear()
                     print("Flashing")
 
+                    # a disabled flash still keeps the timing, so capture can be matched against the pulse
+                    time.sleep(self.sleep_before_flash)
+                    pulse_start = sensor_clock_ns()
                     if not self.disable_flash:
-                        time.sleep(self.sleep_before_flash)
                         GPIO.output(self.gpio_pin, GPIO.LOW)
-                        time.sleep(0.1)
+                    # the planned pulse is known right away, the real end replaces it afterwards
+                    with self.pulses_lock:
+                        self.pulses.append((pulse_start, pulse_start + int(self.pulse_time * 1e9)))
+
+                    time.sleep(self.pulse_time)
+                    if not self.disable_flash:
                         GPIO.output(self.gpio_pin, GPIO.HIGH)
+                    pulse_end = sensor_clock_ns()
 
-                rate.sleep()
+                    with self.pulses_lock:
+                        self.pulses[-1] = (pulse_start, pulse_end)
             except Exception as e:
                 print("Flash exception occurred: ", str(e))
                 traceback.print_exc()
@@ -94,74 +366,375 @@ class FlashControl:
 
     def close(self):
         self.end.set()
+        self.flash_event.set()
+
+
+class CameraModes(IntEnum):
+    IDLE = 0
+    WARM = 1
+
+
+class PhotoRequest:
+    def __init__(self):
+        self.done_event = threading.Event()
+        self.frame = None
+        self.buffer_id = None
+        self.info = {}
+        self.exception = None
+        self.request_time_ns = sensor_clock_ns()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def add_done_callback(self, callback):
+        with self.lock:
+            if not self.done_event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, frame, buffer_id, info=None):
+        with self.lock:
+            self.frame = frame
+            self.buffer_id = buffer_id
+            self.info = info or {}
+        self.complete()
+
+    def set_exception(self, exception):
+        # the photo failed, there is no frame buffer to give back
+        with self.lock:
+            self.exception = exception
+        self.complete()
+
+    def complete(self):
+        with self.lock:
+            self.done_event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                print("Photo callback exception occurred: ", str(e))
+                traceback.print_exc()
+
+    def is_done(self):
+        return self.done_event.is_set()
+
+    def result(self, timeout=None):
+        if not self.done_event.wait(timeout):
+            raise TimeoutError("Photo not taken in time")
+        if self.exception is not None:
+            raise self.exception
+        return self.frame
+
+
+def get_overlap(exposure_start, exposure_end, pulse):
+    return max(min(exposure_end, pulse[1]) - max(exposure_start, pulse[0]), 0)
+
+
+def get_sharpness(frame):
+    # variance of the laplacian, motion blur and missed focus both lower it
+    small = cv2.resize(frame, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+    return cv2.Laplacian(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), cv2.CV_32F).var()
+
+
+class FrameBufferPool:
+    def __init__(self, count, frame_size):
+        # shared memory, so post processing workers read the photos where the camera wrote them
+        self.shared = SharedArrays({"frames": (int(count), int(frame_size[1]), int(frame_size[0]), 3)})
+        self.frames = self.shared.arrays["frames"]
+        self.free = deque(range(len(self.frames)))
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if not self.free:
+                raise RuntimeError("Frame buffer pool is empty, a frame buffer was not released")
+            return self.free.popleft()
+
+    def release(self, buffer_id):
+        with self.lock:
+            self.free.append(buffer_id)
+
+    def close(self):
+        self.frames = None
+        self.shared.close(unlink=True)
+
+
+class FrameRing:
+    def __init__(self, size):
+        # the camera's own request buffers are kept, nothing is copied per frame. Only the camera thread adds and
+        # releases them, others hold the lock while they look at the list.
+        self.requests = [None] * max(int(size), 2)
+        self.exposures = [None] * len(self.requests)
+        self.write_id = 0
+        self.lock = threading.Lock()
+
+    def add(self, request, exposure_start, exposure_end):
+        # the oldest request goes back to the camera so it can be filled again
+        with self.lock:
+            oldest = self.requests[self.write_id]
+            self.requests[self.write_id] = request
+            self.exposures[self.write_id] = (exposure_start, exposure_end)
+            self.write_id = (self.write_id + 1) % len(self.requests)
+        if oldest is not None:
+            oldest.release()
+
+    def get_frames(self):
+        # (request, exposure start, exposure end), oldest first, call with the lock held
+        frames = []
+        for i in range(len(self.requests)):
+            slot_id = (self.write_id + i) % len(self.requests)
+            if self.requests[slot_id] is not None:
+                frames.append((self.requests[slot_id], self.exposures[slot_id][0], self.exposures[slot_id][1]))
+        return frames
+
+    def clear(self):
+        with self.lock:
+            requests = [request for request in self.requests if request is not None]
+            self.requests = [None] * len(self.requests)
+            self.exposures = [None] * len(self.requests)
+        for request in requests:
+            request.release()
+
+
+class SimulatedRequest:
+    def __init__(self, camera, metadata):
+        self.camera = camera
+        self.metadata = metadata
+
+    def get_metadata(self):
+        return self.metadata
+
+    def make_array(self, name):
+        return self.camera.render(self.metadata)
+
+    def release(self):
+        pass
+
+
+# stand-in for Picamera2, frames come on a fixed grid with sensor timestamps and show the flash pulses they overlap
+class SimulatedCamera:
+    def __init__(self, flash_control: FlashControl, size=(2028, 1080), frame_rate=5, exposure_time=300000):
+        self.flash_control = flash_control
+        self.size = size
+        self.frame_duration_ns = int(1e9 / frame_rate)
+        self.exposure_time = min(exposure_time, self.frame_duration_ns // 1000)
+        self.start_ns = None
+        self.next_frame_id = 0
+
+    def start(self):
+        self.start_ns = sensor_clock_ns()
+        self.next_frame_id = 0
+
+    def stop(self):
+        self.start_ns = None
+
+    def close(self):
+        self.stop()
+
+    def capture_request(self):
+        # the frame being exposed right now is the next one to finish
+        frame_id = max(self.next_frame_id, (sensor_clock_ns() - self.start_ns) // self.frame_duration_ns)
+        self.next_frame_id = frame_id + 1
+
+        timestamp = self.start_ns + frame_id * self.frame_duration_ns
+        wait_ns = timestamp + self.exposure_time * 1000 - sensor_clock_ns()
+        if wait_ns > 0:
+            time.sleep(wait_ns / 1e9)
+
+        return SimulatedRequest(self, {"SensorTimestamp": timestamp, "ExposureTime": self.exposure_time,
+                                       "FrameDuration": self.frame_duration_ns // 1000})
+
+    def capture_array(self):
+        request = self.capture_request()
+        frame = request.make_array("main")
+        request.release()
+        return frame
+
+    def render(self, metadata):
+        exposure_start = metadata["SensorTimestamp"]
+        exposure_end = exposure_start + metadata["ExposureTime"] * 1000
+
+        lit = 0
+        for pulse in self.flash_control.get_pulses():
+            lit += get_overlap(exposure_start, exposure_end, pulse)
+        brightness = min(lit / (exposure_end - exposure_start), 1.0)
+
+        frame = np.empty((self.size[1], self.size[0], 3), np.uint8)
+        frame[:] = (int(255 * brightness), int(255 * brightness), 255)
+        return frame
+
+
+class SimulatedMappedArray:
+    def __init__(self, request, stream, reshape=True, write=True):
+        self.request = request
+        self.stream = stream
+        self.array = None
+
+    def __enter__(self):
+        self.array = self.request.make_array(self.stream)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.array = None
 
 
 class CameraControl:
     def __init__(self, flash_control: FlashControl, frame_rate=5, exposure_time=300000, analogue_gain=8.0,
                  size=(2028, 1080), img_format="RGB888", horizontal_flip=True, print_fps=False, show_preview=False,
-                 disable_camera=False):
+                 disable_camera=False, idle_frame_rate=0.0, stop_when_idle=False, flash_capture_timeout=2.0,
+                 frame_ring_size=4, zero_shutter_lag=False, zero_shutter_lag_window=0.5, setup_retry_interval=5.0):
         self.print_fps = print_fps
         self.show_preview = show_preview
         self.disable_camera = disable_camera
         self.horizontal_flip = horizontal_flip
         self.size = size
+        self.frame_rate = frame_rate
+        self.idle_frame_rate = idle_frame_rate
+        self.stop_when_idle = stop_when_idle
+        self.flash_capture_timeout = flash_capture_timeout
+        self.zero_shutter_lag = zero_shutter_lag
+        self.zero_shutter_lag_window = zero_shutter_lag_window
+        # only photos are copied out of the ring, the current and the previous session, and one spare for the hand-off
+        self.frame_pool = FrameBufferPool(7, size)
+        self.frame_ring = FrameRing(frame_ring_size)
 
         self.end = threading.Event()
-        self.photo_event = threading.Event()
-        self.photo_done_event = threading.Event()
+        # taken one at a time, a photo asked for while an older one still hangs waits for it instead of replacing it
+        self.photo_queue = Queue()
+        self.wake_event = threading.Event()
         self.flash_control = flash_control
-        self.last_frame = None
+        self.mode = CameraModes.IDLE
+        self.camera_running = False
+        self.exposure_time = exposure_time
+        self.analogue_gain = analogue_gain
+        self.img_format = img_format
+        self.mapped_array = None
+        self.picam2 = None
+        self.ready = threading.Event()
+        self.ready_time = None
+        self.setup_error = None
+        self.setup_retry_interval = setup_retry_interval
+
+        # picamera2 is opened and configured in the camera thread, the videos are decoded meanwhile
+        thread = threading.Thread(target=self.run)
+        thread.start()
 
+        print("Camera started!")
+
+    def setup_camera(self):
         if not self.disable_camera:
-            from picamera2 import Picamera2
+            from picamera2 import Picamera2, MappedArray
+            from libcamera import Transform
+            self.mapped_array = MappedArray
             self.picam2 = Picamera2()
-            controls = {"FrameRate": frame_rate, "ExposureTime": exposure_time, "AnalogueGain": analogue_gain}
-            preview_config = self.picam2.create_preview_configuration(main={"size": size, "format": img_format},
-                                                                      controls=controls)
+            controls = {"FrameRate": self.frame_rate, "ExposureTime": self.exposure_time,
+                        "AnalogueGain": self.analogue_gain}
+            # mirroring is done by the ISP, frames come out already flipped. The ring holds on to its requests, the
+            # camera needs two more buffers to keep streaming meanwhile.
+            preview_config = self.picam2.create_preview_configuration(main={"size": self.size,
+                                                                            "format": self.img_format},
+                                                                      controls=controls,
+                                                                      transform=Transform(hflip=self.horizontal_flip),
+                                                                      buffer_count=len(self.frame_ring.requests) + 2)
             self.picam2.configure(preview_config)
-            self.picam2.start()
+        else:
+            self.mapped_array = SimulatedMappedArray
+            self.picam2 = SimulatedCamera(self.flash_control, self.size, self.frame_rate, self.exposure_time)
 
-        thread = threading.Thread(target=self.run)
-        thread.start()
+        if not self.stop_when_idle:
+            self.start_camera()
 
-        print("Camera started!")
+        self.ready_time = time.perf_counter()
+        self.setup_error = None
+        self.ready.set()
+
+    def start_camera(self):
+        if not self.camera_running:
+            self.picam2.start()
+            self.camera_running = True
+
+    def stop_camera(self):
+        if self.camera_running:
+            self.frame_ring.clear()
+            self.picam2.stop()
+            self.camera_running = False
 
     def run(self):
         fps = 0
         last_print_time = time.time()
 
+        while not self.end.is_set() and not self.ready.is_set():
+            try:
+                self.setup_camera()
+            except Exception as e:
+                # the home screen shows the error and button presses are ignored until a retry works
+                print("Camera setup exception occurred: ", str(e))
+                traceback.print_exc()
+                self.setup_error = str(e)
+                if self.picam2 is not None:
+                    try:
+                        self.picam2.close()
+                    except Exception:
+                        traceback.print_exc()
+                    self.picam2 = None
+                    self.camera_running = False
+                self.end.wait(self.setup_retry_interval)
+
+        if not self.ready.is_set():
+            self.frame_pool.close()
+            self.fail_photo_requests()
+            return
+
         while not self.end.is_set():
             try:
-                if self.photo_event.is_set():
-                    self.photo_event.clear()
-                    if not self.disable_camera:
-                        self.flash_control.start_flash()
-                        self.last_frame = self.picam2.capture_array()
-                        if self.horizontal_flip:
-                            self.last_frame = cv2.flip(self.last_frame, 1)
+                self.wake_event.clear()
+
+                try:
+                    request = self.photo_queue.get_nowait()
+                except Empty:
+                    request = None
+
+                if request is not None:
+                    try:
+                        self.start_camera()
+                        buffer_id, info = self.capture_photo(request.request_time_ns)
+                    except Exception as e:
+                        print("Photo exception occurred: ", str(e))
+                        traceback.print_exc()
+                        request.set_exception(e)
+                        continue
+                    print("Made photo of size:", self.frame_pool.frames[buffer_id].shape, "shutter lag:",
+                          info["shutter_lag_ms"], "ms, flash alignment:", info["flash_alignment"])
+                    request.set_result(self.frame_pool.frames[buffer_id], buffer_id, info)
+                    fps += 1
+                elif self.mode == CameraModes.IDLE:
+                    # nobody is at the booth, only the debug preview needs frames and only at idle_frame_rate
+                    if self.stop_when_idle:
+                        self.stop_camera()
+
+                    if self.show_preview and self.idle_frame_rate > 0:
+                        self.start_camera()
+                        self.show_preview_frame()
+                        fps += 1
+                        self.wake_event.wait(1.0 / self.idle_frame_rate)
                     else:
-                        self.flash_control.start_flash()
-                        ones = np.ones((self.size[1], self.size[0], 1), np.uint8) * 255
-                        zeros = np.zeros((self.size[1], self.size[0], 1), np.uint8)
-
-                        frame = cv2.merge([zeros, zeros, ones])
-                        self.last_frame = frame
-                    print("Made photo of size:", self.last_frame.shape)
-                    self.photo_done_event.set()
+                        self.wake_event.wait(0.5)
                 else:
-                    if not self.disable_camera:
-                        frame = self.picam2.capture_array()
-                        if self.horizontal_flip:
-                            frame = cv2.flip(frame, 1)
-                        if self.show_preview:
-                            preview = cv2.resize(frame.copy(), (640, 480))
-                            cv2.imshow("preview", preview)
-                            cv2.waitKey(1)
-                    else:
-                        time.sleep(0.2)
+                    # someone is about to pose, keep the latest frames for the photo
+                    self.start_camera()
+                    self.capture_to_ring()
+                    fps += 1
+                    if self.show_preview:
+                        with self.frame_ring.lock:
+                            request = self.frame_ring.get_frames()[-1][0]
+                        with self.mapped_array(request, "main", write=False) as m:
+                            preview = cv2.resize(m.array[:self.size[1], :self.size[0]], (640, 480))
+                        self.show_preview_frame(preview)
 
                 if self.print_fps:
-                    fps += 1
                     if time.time() - last_print_time > 1:
                         last_print_time = time.time()
                         print("Camera FPS: ", fps)
@@ -170,91 +743,289 @@ class CameraControl:
                 print("Camera exception occurred: ", str(e))
                 traceback.print_exc()
 
-    def start_photo(self):
-        self.photo_event.set()
-        self.photo_done_event.clear()
+        self.stop_camera()
+        self.frame_pool.close()
+        self.fail_photo_requests()
 
-    def is_done(self):
-        return self.photo_done_event.is_set()
+    def fail_photo_requests(self):
+        # nobody takes photos any more, whoever waits for one gets an error instead of a timeout
+        while True:
+            try:
+                request = self.photo_queue.get_nowait()
+            except Empty:
+                return
+            request.set_exception(RuntimeError("Camera closed"))
+
+    def capture_to_ring(self):
+        request = self.picam2.capture_request()
+        try:
+            metadata = request.get_metadata()
+            # the sensor timestamp is the start of the exposure
+            exposure_start = metadata["SensorTimestamp"]
+            exposure_end = exposure_start + metadata["ExposureTime"] * 1000
+        except Exception:
+            request.release()
+            raise
+
+        self.frame_ring.add(request, exposure_start, exposure_end)
+        return exposure_start, exposure_end
+
+    def copy_to_buffer(self, request):
+        # the only copy of a frame, into shared memory where the post processing workers read it
+        buffer_id = self.frame_pool.acquire()
+        frame = self.frame_pool.frames[buffer_id]
+        try:
+            with self.mapped_array(request, "main", write=False) as m:
+                # buffer rows may be padded
+                frame[:] = m.array[:frame.shape[0], :frame.shape[1]]
+        except Exception:
+            self.frame_pool.release(buffer_id)
+            raise
+        return buffer_id
+
+    def capture_photo(self, request_time_ns):
+        if self.zero_shutter_lag:
+            photo = self.select_zero_lag_frame(request_time_ns)
+            if photo is None:
+                # nothing recent in the ring, the camera was just started
+                self.capture_to_ring()
+                photo = self.select_zero_lag_frame(request_time_ns)
+            request, info = photo
+        else:
+            request, info = self.capture_with_flash(request_time_ns)
+        return self.copy_to_buffer(request), info
+
+    def get_request_sharpness(self, request):
+        with self.mapped_array(request, "main", write=False) as m:
+            return get_sharpness(m.array[:self.size[1], :self.size[0]])
+
+    def select_zero_lag_frame(self, request_time_ns):
+        # the photo is already taken, the flash would only go off after it so it is not used
+        window_start = request_time_ns - int(self.zero_shutter_lag_window * 1e9)
+        with self.frame_ring.lock:
+            frames = [frame for frame in self.frame_ring.get_frames() if frame[1] >= window_start]
+        if not frames:
+            return None
+
+        # scored without the lock, only this thread releases the requests of the ring
+        request, exposure_start, _ = max(frames, key=lambda f: self.get_request_sharpness(f[0]))
+        return request, {"shutter_lag_ms": round((exposure_start - request_time_ns) / 1e6, 1),
+                         "sensor_timestamp": exposure_start, "flash_alignment": None}
+
+    def capture_with_flash(self, request_time_ns):
+        self.flash_control.start_flash()
+
+        # the pulse is only known once it ended, frames exposed meanwhile wait in the ring
+        pulse = None
+        best = None
+        deadline = time.monotonic() + self.flash_capture_timeout
+        while True:
+            exposure_start, _ = self.capture_to_ring()
+
+            if pulse is None:
+                pulse = self.flash_control.get_pulse(request_time_ns)
+
+            if pulse is not None:
+                # ties go to the newest frame
+                with self.frame_ring.lock:
+                    best = max(self.frame_ring.get_frames(), key=lambda f: (get_overlap(f[1], f[2], pulse), f[1]))
+                if get_overlap(best[1], best[2], pulse) >= pulse[1] - pulse[0] or exposure_start >= pulse[1]:
+                    # the whole pulse is in one frame, or the frames already start after the pulse
+                    break
 
-    def get_photo(self):
-        return self.last_frame.copy()
+            if time.monotonic() > deadline:
+                print("No frame matched the flash in time, using the best one seen")
+                break
+
+        if best is None:
+            with self.frame_ring.lock:
+                best = self.frame_ring.get_frames()[-1]
+
+        request, exposure_start, exposure_end = best
+        info = {"shutter_lag_ms": round((exposure_start - request_time_ns) / 1e6, 1),
+                "sensor_timestamp": exposure_start, "flash_alignment": 0.0}
+        if pulse is not None:
+            overlap = get_overlap(exposure_start, exposure_end, pulse)
+            info["flash_alignment"] = round(overlap / (pulse[1] - pulse[0]), 3)
+        return request, info
+
+    def show_preview_frame(self, preview=None):
+        if preview is None:
+            preview = cv2.resize(self.picam2.capture_array(), (640, 480))
+        cv2.imshow("preview", preview)
+        cv2.waitKey(1)
+
+    def set_mode(self, mode):
+        if mode != self.mode:
+            self.mode = mode
+            self.wake_event.set()
+
+    def start_photo(self, callback=None):
+        request = PhotoRequest()
+        if callback is not None:
+            request.add_done_callback(callback)
+
+        # with zero shutter lag the frame is already in the ring, the camera thread only picks and copies it
+        self.photo_queue.put(request)
+        self.wake_event.set()
+        return request
 
     def close(self):
         self.end.set()
+        self.wake_event.set()
 
 
 class PrinterControl:
-    def __init__(self, wait_for_print, disable_printer=False):
+    def __init__(self, wait_for_print, disable_printer=False, job_poll_interval=0.5, fake_print_time=3.0,
+                 connect_retry_interval=1.0):
         self.disable_printer = disable_printer
-
-        if not self.disable_printer:
-            exception_count = 0
-            while True:
-                try:
-                    if exception_count > 100:
-                        exit(0)
-                    self.conn = cups.Connection()
-                    printers = self.conn.getPrinters()
-                    self.default_printer = list(printers.keys())[0]
-                    print("Found printer: ", self.default_printer)
-                    cups.setUser('kidier')
-                except Exception:
-                    traceback.print_exc()
-                    _ = cv2.namedWindow("window", cv2.WND_PROP_FULLSCREEN)
-                    cv2.moveWindow("window", 0, 0)
-                    cv2.setWindowProperty("window", cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
-                    frame = np.zeros((1920, 1080, 3), np.uint8)
-                    cv2.putText(frame, "Waiting", (400, 100), cv2.FONT_HERSHEY_SIMPLEX, 3, (255, 255, 255), 4, 16)
-                    cv2.putText(frame, "for", (500, 200), cv2.FONT_HERSHEY_SIMPLEX, 3, (255, 255, 255), 4, 16)
-                    cv2.putText(frame, "printer", (400, 300), cv2.FONT_HERSHEY_SIMPLEX, 3, (255, 255, 255), 4, 16)
-                    dots_str = ""
-                    for i in range(exception_count % 4):
-                        dots_str += "."
-                    cv2.putText(frame, dots_str, (500, 400), cv2.FONT_HERSHEY_SIMPLEX, 3, (255, 255, 255), 4, 16)
-
-                    cv2.imshow("window", frame)
-                    if cv2.waitKey(400) == ord("q"):
-                        exit(0)
-                    exception_count += 1
-
-                else:
-                    cv2.destroyAllWindows()
-                    break
+        self.connect_retry_interval = connect_retry_interval
+        self.ready = threading.Event()
+        self.ready_time = None
+        self.setup_error = None
+
+        self.conn = None
+        self.default_printer = None
+        if self.disable_printer:
+            self.conn = FakeConnection(print_time=fake_print_time)
+            self.default_printer = list(self.conn.getPrinters().keys())[0]
+            self.ready_time = time.perf_counter()
+            self.ready.set()
 
         self.end = threading.Event()
         self.print_done_event = threading.Event()
         self.print_changed = threading.Event()
-        self.print_queue = Queue()
+        # pending jobs as [filename, copies], copies of the same file added back to back are merged
+        self.print_queue = deque()
+        self.print_lock = threading.Lock()
         self.wait_for_print = wait_for_print
+        self.job_poll_interval = job_poll_interval
+        self.job_id = None
+        self.job_state = None
+        self.job_copies = 0
+        self.job_sheets_completed = 0
+        self.job_listeners = []
 
         thread = threading.Thread(target=self.run)
         thread.start()
 
         print("Printer started!")
 
+    def connect(self):
+        # the printer is looked for in the printer thread, jobs added meanwhile wait in the queue
+        attempts = 0
+        while not self.end.is_set():
+            try:
+                self.conn = cups.Connection()
+                printers = self.conn.getPrinters()
+                self.default_printer = list(printers.keys())[0]
+                print("Found printer: ", self.default_printer)
+                cups.setUser('kidier')
+            except Exception as e:
+                # still retried, jobs wait in the queue meanwhile
+                self.setup_error = str(e)
+                if attempts % 10 == 0:
+                    print("Waiting for printer: ", str(e))
+                attempts += 1
+                self.end.wait(self.connect_retry_interval)
+            else:
+                self.ready_time = time.perf_counter()
+                self.setup_error = None
+                self.ready.set()
+                self.print_changed.set()
+                return
+
     def run(self):
-        rate = Rate(10)
+        scheduler = FrameScheduler(10)
+
+        if not self.ready.is_set():
+            self.connect()
 
         while not self.end.is_set():
             try:
-                if not self.print_queue.empty():
+                with self.print_lock:
+                    if self.print_queue:
+                        filename, copies = self.print_queue.popleft()
+                        self.job_copies = copies
+                        self.job_sheets_completed = 0
+                    else:
+                        filename = None
+                        self.print_done_event.set()
+
+                if filename is not None:
                     self.print_changed.set()
                     self.print_done_event.clear()
-                    filename = self.print_queue.get()
-                    if not self.disable_printer:
-                        self.conn.printFile(self.default_printer, filename, "boothy", {'fit-to-page': 'True'})
-                    print("Print job successfully created: ", filename)
-                    print("Sleeping for:", self.wait_for_print)
-                    time.sleep(self.wait_for_print)
-                else:
-                    self.print_done_event.set()
+                    try:
+                        self.job_id = self.conn.printFile(self.default_printer, filename, "boothy",
+                                                          {'fit-to-page': 'True', 'copies': str(copies)})
+                    except Exception as e:
+                        # the job never got to cups, the listeners still hear about it like about any failed job
+                        print("Print job could not be created: ", filename, str(e))
+                        traceback.print_exc()
+                        self.job_state = JobState.ABORTED
+                    else:
+                        print("Print job successfully created: ", filename, "copies:", copies, "id:", self.job_id)
+
+                        self.job_state = self.wait_for_job(self.job_id, copies)
+                        print("Print job", self.job_id, "finished with state:", self.job_state.name)
+
+                    # some drivers never report the sheet count, a completed job printed everything
+                    printed = copies if self.job_state == JobState.COMPLETED else self.job_sheets_completed
+                    for listener in self.job_listeners:
+                        listener(filename, copies, self.job_state, printed)
+
+                    with self.print_lock:
+                        self.job_id = None
+                        self.job_copies = 0
+                        self.job_sheets_completed = 0
+                        if not self.print_queue:
+                            self.print_done_event.set()
+                    self.print_changed.set()
 
-                rate.sleep()
+                scheduler.sleep()
             except Exception as e:
                 print("Printer exception occurred: ", str(e))
                 traceback.print_exc()
 
+    def wait_for_job(self, job_id, copies=1):
+        # wait_for_print is only an upper bound now, for jobs that hang in the printer
+        timeout = self.wait_for_print * copies
+        deadline = time.monotonic() + timeout
+        state = JobState.PENDING
+
+        while not self.end.is_set():
+            try:
+                attributes = get_job_attributes(self.conn, job_id)
+                new_state = JobState(attributes["job-state"])
+                if new_state != state:
+                    print("Print job", job_id, "state:", new_state.name)
+                    state = new_state
+
+                sheets_completed = min(int(attributes.get("job-media-sheets-completed", 0)), copies)
+                if sheets_completed != self.job_sheets_completed:
+                    with self.print_lock:
+                        self.job_sheets_completed = sheets_completed
+                    self.print_changed.set()
+
+                if state in FINISHED_JOB_STATES:
+                    return state
+            except Exception as e:
+                print("Printer job state exception occurred: ", str(e))
+
+            if time.monotonic() > deadline:
+                print("Print job", job_id, "did not finish in", timeout, "s, cancelling it")
+                # left in cups a hanging job would hold back every print queued after it
+                try:
+                    self.conn.cancelJob(job_id)
+                    state = JobState.CANCELED
+                except Exception as e:
+                    print("Print job cancel exception occurred: ", str(e))
+                return state
+
+            self.end.wait(self.job_poll_interval)
+
+        return state
+
     def changed(self):
         val = self.print_changed.is_set()
         self.print_changed.clear()
@@ -263,17 +1034,430 @@ class PrinterControl:
     def is_done(self):
         return self.print_done_event.is_set()
 
-    def add(self, filename):
-        self.print_done_event.clear()
-        self.print_queue.put(filename)
+    def add_job_listener(self, callback):
+        # called from the printer thread with (filename, copies, state, printed) after every job
+        self.job_listeners.append(callback)
+
+    def add(self, filename, copies=1):
+        with self.print_lock:
+            self.print_done_event.clear()
+            if self.print_queue and self.print_queue[-1][0] == filename:
+                self.print_queue[-1][1] += copies
+            else:
+                self.print_queue.append([filename, copies])
 
     def get_print_size(self):
-        return self.print_queue.qsize()
+        # copies not started yet, the one being printed right now does not count
+        with self.print_lock:
+            waiting = sum(copies for _, copies in self.print_queue)
+            if self.job_copies > 0:
+                waiting += self.job_copies - self.job_sheets_completed - 1
+            return max(waiting, 0)
+
+    def close(self):
+        self.end.set()
+
+
+class ImageWriteJob:
+    def __init__(self, count, callback=None):
+        self.remaining = count
+        self.success = True
+        self.callback = callback
+        self.lock = threading.Lock()
+
+    def file_done(self, success):
+        with self.lock:
+            self.remaining -= 1
+            self.success = self.success and success
+            finished = self.remaining == 0
+
+        if finished and self.callback is not None:
+            self.callback(self.success)
+
+
+class ImageWriter:
+    def __init__(self, workers=2, queue_size=16):
+        self.end = threading.Event()
+        self.write_queue = Queue(maxsize=queue_size)
+
+        # cv2.imwrite releases the GIL while encoding, so plain threads are enough here
+        for _ in range(max(int(workers), 1)):
+            thread = threading.Thread(target=self.run)
+            thread.start()
+
+        print("Image writer started!")
+
+    def save(self, images, callback=None):
+        job = ImageWriteJob(len(images), callback)
+        for path, image in images:
+            # called from the render loop, a stalled disk fails the save instead of freezing the screen
+            try:
+                self.write_queue.put_nowait((job, path, image))
+            except Full:
+                print("Image writer queue is full, not saving: ", path)
+                job.file_done(False)
+
+    def run(self):
+        while not self.end.is_set() or not self.write_queue.empty():
+            try:
+                job, path, image = self.write_queue.get(timeout=0.1)
+            except Empty:
+                continue
+
+            success = False
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                success = cv2.imwrite(path, image)
+                if not success:
+                    print("Could not write image: ", path)
+            except Exception as e:
+                print("Image writer exception occurred: ", str(e))
+                traceback.print_exc()
+
+            try:
+                job.file_done(success)
+            except Exception as e:
+                print("Image writer callback exception occurred: ", str(e))
+                traceback.print_exc()
 
     def close(self):
         self.end.set()
 
 
+class StripCompositor:
+    def __init__(self, output_image_background, print_background, layout, buffers=2, canvases=None):
+        self.crop = layout.crop
+        self.small_imgs = layout.small_imgs
+
+        # the strip is the left part of the print sheet, so both are views of one canvas; only the photo slots
+        # change between sessions, the backgrounds are painted once here. The caller picks the canvas, a canvas is
+        # composed again only when nothing reads the previous session from it any more.
+        self.canvases = []
+        self.strips = []
+        self.slots = []
+        for canvas_id in range(buffers):
+            if canvases is None:
+                canvas = np.array(print_background, dtype=np.uint8, copy=True)
+                strip = layout.output_image.view(canvas)
+                strip[:] = output_image_background
+            else:
+                # shared canvases are painted once by their owner, workers only fill the photo slots
+                canvas = canvases[canvas_id]
+                strip = layout.output_image.view(canvas)
+
+            self.canvases.append(canvas)
+            self.strips.append(strip)
+            self.slots.append([region.view(strip) for region in self.small_imgs])
+
+    def compose(self, frames, canvas_id=0):
+        for frame, slot, region in zip(frames, self.slots[canvas_id], self.small_imgs):
+            cv2.resize(self.crop.view(frame), region.size, dst=slot)
+
+        return self.strips[canvas_id], self.canvases[canvas_id]
+
+
+def make_preview_lut(contrast, brightness):
+    # same values as cv2.addWeighted(image, contrast, zeros, 0, brightness), rounding half to even and saturating
+    return np.clip(np.rint(np.arange(256) * contrast + brightness), 0, 255).astype(np.uint8)
+
+
+def render_preview(image, size, lut=None, dst=None):
+    # resize straight into the destination and apply the lut there, no full size temporaries
+    preview = cv2.resize(image, (int(size[0]), int(size[1])), dst=dst)
+    if lut is not None:
+        preview = cv2.LUT(preview, lut, dst=preview)
+    return preview
+
+
+class SharedArrays:
+    def __init__(self, shapes, name=None):
+        offsets = {}
+        total = 0
+        for key, shape in shapes.items():
+            offsets[key] = total
+            total += int(np.prod(shape))
+
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=total)
+        # frombuffer keeps the buffer exported, so closing refuses to unmap while a view is still alive
+        self.arrays = {key: np.frombuffer(self.shm.buf, np.uint8, int(np.prod(shape)), offsets[key]).reshape(shape)
+                       for key, shape in shapes.items()}
+
+    def close(self, unlink=False):
+        self.arrays = None
+        if unlink:
+            self.shm.unlink()
+        try:
+            self.shm.close()
+        except BufferError:
+            # somebody still holds a view, the block is unmapped together with the last one
+            pass
+
+
+# state of a post processing worker process, or of the main process when jobs run inline
+worker_state = {}
+
+
+def init_post_process_worker(config):
+    if "shared_memory_name" in config:
+        worker_state["shared"] = SharedArrays(config["shapes"], config["shared_memory_name"])
+        worker_state["frame_pool"] = SharedArrays({"frames": config["frame_pool_shape"]}, config["frame_pool_name"])
+        arrays = dict(worker_state["shared"].arrays)
+        arrays["frames"] = worker_state["frame_pool"].arrays["frames"]
+        atexit.register(close_post_process_worker)
+    else:
+        arrays = config["arrays"]
+
+    worker_state["arrays"] = arrays
+    worker_state["config"] = config
+    worker_state["compositor"] = StripCompositor(None, None, config["layout"], len(arrays["canvases"]),
+                                                 arrays["canvases"])
+
+
+def close_post_process_worker():
+    # the views go first, the owner in the main process unlinks the blocks
+    shared = [worker_state.pop(key) for key in ("shared", "frame_pool") if key in worker_state]
+    worker_state.clear()
+    for arrays in shared:
+        arrays.close()
+
+
+def post_process_ping():
+    return os.getpid()
+
+
+def post_process_preview(buffer_id, photo_id, frame_id):
+    arrays = worker_state["arrays"]
+    config = worker_state["config"]
+    render_preview(arrays["frames"][frame_id], config["layout"].frame_preview.size, config["preview_lut"],
+                   arrays["frame_previews"][buffer_id, photo_id])
+
+
+def post_process_compose(buffer_id, frame_ids):
+    arrays = worker_state["arrays"]
+    config = worker_state["config"]
+    strip, _ = worker_state["compositor"].compose([arrays["frames"][frame_id] for frame_id in frame_ids], buffer_id)
+    render_preview(strip, config["layout"].confirm_img_preview.size, config["preview_lut"],
+                   arrays["confirm_previews"][buffer_id])
+
+
+def post_process_save(buffer_id, name, path):
+    image = get_post_process_image(worker_state["arrays"], worker_state["config"], buffer_id, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    success = cv2.imwrite(path, image)
+    if not success:
+        print("Could not write image: ", path)
+    return success
+
+
+def get_post_process_image(arrays, config, buffer_id, name):
+    if name == "print":
+        return arrays["canvases"][buffer_id]
+    if name == "strip":
+        return config["layout"].output_image.view(arrays["canvases"][buffer_id])
+    # photos are named by their frame buffer
+    return arrays["frames"][name]
+
+
+class InlineExecutor:
+    # runs jobs right away in the calling thread, used when no worker processes are configured
+    def submit(self, function, *args):
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class PostProcessor:
+    def __init__(self, workers, output_image_background, print_background, layout, frame_pool,
+                 increase_preview_brightness, preview_contrast_value, preview_brightness_value, image_writer=None,
+                 buffers=2):
+        self.workers = int(workers)
+        self.image_writer = image_writer
+
+        frame_preview_w, frame_preview_h = layout.frame_preview.size
+        confirm_preview_w, confirm_preview_h = layout.confirm_img_preview.size
+        shapes = {"canvases": (buffers,) + print_background.shape,
+                  "frame_previews": (buffers, 3, frame_preview_h, frame_preview_w, 3),
+                  "confirm_previews": (buffers, confirm_preview_h, confirm_preview_w, 3)}
+
+        # the layout goes to the workers as it is, its regions already hold the slices and resize targets
+        config = {"shapes": shapes, "layout": layout, "preview_lut": None}
+        if increase_preview_brightness:
+            config["preview_lut"] = make_preview_lut(preview_contrast_value, preview_brightness_value)
+
+        self.shared = None
+        if self.workers > 0:
+            # photos and results stay in shared memory, only buffer ids and file names go through the pool pipes
+            self.shared = SharedArrays(shapes)
+            self.arrays = dict(self.shared.arrays)
+            config["shared_memory_name"] = self.shared.shm.name
+            config["frame_pool_name"] = frame_pool.shared.shm.name
+            config["frame_pool_shape"] = frame_pool.frames.shape
+        else:
+            self.arrays = {key: np.empty(shape, np.uint8) for key, shape in shapes.items()}
+            config["arrays"] = self.arrays
+        self.arrays["frames"] = frame_pool.frames
+
+        # backgrounds are painted once, workers only ever write the photo slots
+        for canvas in self.arrays["canvases"]:
+            canvas[:] = print_background
+            layout.output_image.view(canvas)[:] = output_image_background
+
+        self.config = config
+        self.executor = None
+        self.start_executor()
+
+        # no buffer until a session starts, the last one decides where the round robin continues
+        self.buffer_id = None
+        self.last_buffer_id = buffers - 1
+        self.buffers = buffers
+        self.frame_ids = [None, None, None]
+        self.preview_futures = [None, None, None]
+        self.compose_future = None
+        # jobs still using every buffer and the callback of the session that ended in it, a buffer is taken for
+        # a new session only after its previews, composition and saved files are all done
+        self.buffer_jobs = [0] * buffers
+        self.buffer_done_callbacks = [None] * buffers
+        self.buffer_lock = threading.Lock()
+
+        print("Post processor started with " + str(self.workers) + " workers!")
+
+    def start_executor(self):
+        if self.workers > 0:
+            # spawn, forking a process that already runs camera and printer threads is not safe
+            self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=init_post_process_worker, initargs=(self.config,))
+            # start the workers now, importing cv2 in them takes a while
+            for _ in range(self.workers):
+                self.executor.submit(post_process_ping)
+        else:
+            init_post_process_worker(self.config)
+            self.executor = InlineExecutor()
+
+    def restart_executor(self):
+        # a worker died, the pool refuses every job after that, the shared arrays are still fine
+        print("Restarting post processing workers!")
+        self.executor.shutdown(wait=False)
+        self.start_executor()
+
+    def submit(self, function, *args):
+        buffer_id = self.buffer_id
+        self.job_started(buffer_id)
+        # a broken pool raises right in submit, the error is handed over in the future like any other
+        try:
+            future = self.executor.submit(function, *args)
+        except Exception as e:
+            future = Future()
+            future.set_exception(e)
+        future.add_done_callback(lambda f: self.job_done(buffer_id))
+        return future
+
+    def job_started(self, buffer_id):
+        with self.buffer_lock:
+            self.buffer_jobs[buffer_id] += 1
+
+    def job_done(self, buffer_id):
+        callback = None
+        with self.buffer_lock:
+            self.buffer_jobs[buffer_id] -= 1
+            if self.buffer_jobs[buffer_id] == 0:
+                callback = self.buffer_done_callbacks[buffer_id]
+                self.buffer_done_callbacks[buffer_id] = None
+
+        if callback is not None:
+            callback()
+
+    def next_session(self, done_callback=None):
+        # done_callback is called once nothing reads the frames of the session that ends or writes its files,
+        # this never waits, the next session takes a buffer in start_session
+        with self.buffer_lock:
+            if self.buffer_id is not None:
+                if self.buffer_jobs[self.buffer_id] > 0:
+                    self.buffer_done_callbacks[self.buffer_id] = done_callback
+                    done_callback = None
+                self.last_buffer_id = self.buffer_id
+                self.buffer_id = None
+
+        if done_callback is not None:
+            done_callback()
+
+        self.frame_ids = [None, None, None]
+        self.preview_futures = [None, None, None]
+        self.compose_future = None
+
+    def start_session(self):
+        # false while every buffer still holds a session being saved, the caller asks again on its next tick
+        with self.buffer_lock:
+            if self.buffer_id is None:
+                order = [(self.last_buffer_id + i) % self.buffers for i in range(1, self.buffers + 1)]
+                free = [buffer_id for buffer_id in order if self.buffer_jobs[buffer_id] == 0]
+                if not free:
+                    return False
+                self.buffer_id = free[0]
+            return True
+
+    def add_photo(self, photo_id, frame_id):
+        # the photo is read where the camera wrote it, the caller keeps owning the frame buffer
+        self.frame_ids[photo_id] = frame_id
+        self.preview_futures[photo_id] = self.submit(post_process_preview, self.buffer_id, photo_id, frame_id)
+        return self.arrays["frames"][frame_id]
+
+    def get_preview(self, photo_id):
+        future = self.preview_futures[photo_id]
+        if future is None or not future.done():
+            return None
+        future.result()
+        return self.arrays["frame_previews"][self.buffer_id, photo_id]
+
+    def compose(self):
+        self.compose_future = self.submit(post_process_compose, self.buffer_id, list(self.frame_ids))
+
+    def get_composition(self):
+        if self.compose_future is None or not self.compose_future.done():
+            return None
+        self.compose_future.result()
+
+        canvas = self.arrays["canvases"][self.buffer_id]
+        strip = get_post_process_image(self.arrays, self.config, self.buffer_id, "strip")
+        return strip, canvas, self.arrays["confirm_previews"][self.buffer_id]
+
+    def save(self, images, callback=None):
+        # images are (path, name), name is print, strip or the photo number, 0 to 2
+        images = [(path, self.frame_ids[int(name)] if name.isdigit() else name) for path, name in images]
+        if self.workers == 0:
+            # the writer threads read the canvas and frames directly, the buffer is busy until every file is written
+            buffer_id = self.buffer_id
+            self.job_started(buffer_id)
+
+            def saved(success):
+                self.job_done(buffer_id)
+                if callback is not None:
+                    callback(success)
+
+            self.image_writer.save([(path, get_post_process_image(self.arrays, self.config, buffer_id, name))
+                                    for path, name in images], saved)
+            return
+
+        job = ImageWriteJob(len(images), callback)
+        for path, name in images:
+            future = self.submit(post_process_save, self.buffer_id, name, path)
+            future.add_done_callback(lambda f: job.file_done(f.exception() is None and f.result()))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.arrays = None
+        self.config.pop("arrays", None)
+        if self.workers == 0:
+            close_post_process_worker()
+        if self.shared is not None:
+            self.shared.close(unlink=True)
+
+
 class States(IntEnum):
     HOME = 0
     PREPARE = 1
@@ -291,6 +1475,300 @@ class States(IntEnum):
 #     IMAGE = 0
 #     VIDEO = 1
 
+class FrameSequence:
+    def __init__(self, frames):
+        # one view object per frame, so the same frame is also the same object every time it is read
+        self.frames = list(frames)
+        self.frame_id = 0
+
+    def read(self):
+        frame = self.frames[self.frame_id]
+        last = self.frame_id == len(self.frames) - 1
+
+        if last:
+            self.frame_id = 0
+        else:
+            self.frame_id += 1
+
+        return frame, last
+
+    def read_at(self, index):
+        if index >= len(self.frames):
+            return self.frames[-1], True
+
+        self.frame_id = index
+        return self.frames[index], False
+
+    def rewind(self):
+        self.frame_id = 0
+
+    def close(self):
+        pass
+
+
+class VideoStream:
+    def __init__(self, filename, size, frame_budget=30):
+        self.filename = filename
+        self.size = (int(size[0]), int(size[1]))
+
+        # one slot is always held by the reader, so at least two are needed
+        frame_budget = max(int(frame_budget), 2)
+        self.slots = [np.empty((self.size[1], self.size[0], 3), np.uint8) for _ in range(frame_budget)]
+        self.last_flags = [False] * frame_budget
+        self.read_id = 0
+        self.write_id = 0
+        self.ready = 0
+
+        self.current_frame = None
+        self.current_last = True
+        self.position = -1
+
+        self.condition = threading.Condition()
+        self.end = threading.Event()
+
+        self.cap = cv2.VideoCapture(filename)
+        ret, self.first_frame = self.cap.read()
+        if not ret:
+            print("Could not read video: " + filename)
+            exit(0)
+
+        thread = threading.Thread(target=self.run)
+        thread.start()
+
+    def run(self):
+        pending = self.first_frame
+        self.first_frame = None
+
+        spare = None
+        while not self.end.is_set():
+            try:
+                ret, frame = self.cap.read(spare)
+                last = not ret
+
+                if last:
+                    self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    ret, frame = self.cap.read(spare)
+                    if not ret:
+                        self.cap.release()
+                        self.cap = cv2.VideoCapture(self.filename)
+                        ret, frame = self.cap.read(spare)
+                    if not ret:
+                        print("Could not loop video: " + self.filename)
+                        break
+
+                self.push(pending, last)
+                spare, pending = pending, frame
+            except Exception as e:
+                print("Video stream exception occurred: ", str(e))
+                traceback.print_exc()
+
+        self.cap.release()
+
+    def push(self, frame, last):
+        with self.condition:
+            while self.ready >= len(self.slots) - 1 and not self.end.is_set():
+                self.condition.wait(0.1)
+            if self.end.is_set():
+                return
+            slot = self.slots[self.write_id]
+
+        cv2.resize(frame, self.size, dst=slot)
+
+        with self.condition:
+            self.last_flags[self.write_id] = last
+            self.write_id = (self.write_id + 1) % len(self.slots)
+            self.ready += 1
+            self.condition.notify_all()
+
+    def read(self):
+        with self.condition:
+            while self.ready == 0:
+                if self.current_frame is not None:
+                    # decoder fell behind, keep showing the current frame instead of stalling the UI
+                    return self.current_frame, False
+                self.condition.wait(0.1)
+
+            self.next_frame()
+
+            return self.current_frame, self.current_last
+
+    def next_frame(self):
+        self.current_frame = self.slots[self.read_id]
+        self.position = 0 if self.current_last else self.position + 1
+        self.current_last = self.last_flags[self.read_id]
+        self.read_id = (self.read_id + 1) % len(self.slots)
+        self.ready -= 1
+        self.condition.notify_all()
+
+    def read_at(self, index):
+        with self.condition:
+            while self.current_frame is None and self.ready == 0 and not self.end.is_set():
+                self.condition.wait(0.1)
+
+            # frames between the current one and index are dropped, the decoder is never waited for
+            while self.position < index:
+                if self.current_last and self.position >= 0:
+                    return self.current_frame, True
+                if self.ready == 0:
+                    break
+                self.next_frame()
+
+            return self.current_frame, False
+
+    def rewind(self):
+        while not self.current_last and not self.end.is_set():
+            with self.condition:
+                if self.ready == 0:
+                    self.condition.wait(0.1)
+                    continue
+            self.read()
+        self.position = -1
+
+    def close(self):
+        self.end.set()
+        with self.condition:
+            self.condition.notify_all()
+
+
+class PlaybackClock:
+    def __init__(self, source, fps, max_gap=1.0):
+        self.source = source
+        self.fps = fps
+        self.max_gap = max_gap
+        self.start_time = None
+        self.last_read_time = None
+
+    def read(self):
+        now = time.monotonic()
+        if self.start_time is None:
+            self.start_time = now
+        elif now - self.last_read_time > self.max_gap:
+            # another state was on screen, continue where playback stopped instead of fast forwarding
+            self.start_time += now - self.last_read_time
+        self.last_read_time = now
+
+        frame, ended = self.source.read_at(int((now - self.start_time) * self.fps))
+        if ended:
+            self.rewind()
+        return frame, ended
+
+    def rewind(self):
+        self.source.rewind()
+        self.start_time = None
+
+    def close(self):
+        self.source.close()
+
+
+class FrameCache:
+    CACHE_VERSION = 2
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        os.makedirs(self.cache_path, exist_ok=True)
+
+    def get_key(self, filename, size):
+        # one entry per source file and size, files with the same name in different folders do not collide
+        path = os.path.abspath(filename)
+        name = os.path.basename(path).replace(".", "_")
+        return name + "_" + hashlib.sha1(path.encode()).hexdigest()[:8] + "_" + str(size[0]) + "x" + str(size[1]) + \
+            "_v" + str(self.CACHE_VERSION)
+
+    def get_source(self, filename):
+        stat_result = os.stat(filename)
+        return {"size": stat_result.st_size, "mtime_ns": stat_result.st_mtime_ns}
+
+    def get_source_hash(self, filename):
+        file_hash = hashlib.sha1()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    def get(self, filename, size, decode):
+        key = self.get_key(filename, size)
+
+        frames = self.load(key, size, filename)
+        if frames is None:
+            print("Building frame cache for: " + filename)
+            frames = self.store(key, size, decode(), filename)
+        return frames
+
+    def load(self, key, size, filename):
+        frames_path = os.path.join(self.cache_path, key + ".frames")
+        meta_path = os.path.join(self.cache_path, key + ".json")
+
+        if not os.path.exists(meta_path) or not os.path.exists(frames_path):
+            return None
+
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            shape = (meta["frames"], size[1], size[0], 3)
+
+            if os.path.getsize(frames_path) != int(np.prod(shape)):
+                return None
+
+            # the video is only read again when its size or modification time changed, e.g. after a copy
+            source = self.get_source(filename)
+            if meta["source"] != source:
+                if meta["source_hash"] != self.get_source_hash(filename):
+                    return None
+                meta["source"] = source
+                self.write_meta(meta_path, meta)
+
+            return np.memmap(frames_path, dtype=np.uint8, mode="r", shape=shape)
+        except Exception:
+            traceback.print_exc()
+            return None
+
+    def write_meta(self, meta_path, meta):
+        tmp_path = meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    def store(self, key, size, frames, filename):
+        frames_path = os.path.join(self.cache_path, key + ".frames")
+        meta_path = os.path.join(self.cache_path, key + ".json")
+        tmp_path = frames_path + ".tmp"
+
+        source = self.get_source(filename)
+        source_hash = self.get_source_hash(filename)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        frame_count = 0
+        with open(tmp_path, "wb") as f:
+            for frame in frames:
+                f.write(np.ascontiguousarray(frame).data)
+                frame_count += 1
+
+        if frame_count == 0:
+            os.remove(tmp_path)
+            print("No frames to cache for: " + key)
+            exit(0)
+
+        os.replace(tmp_path, frames_path)
+        # metadata is written last, so an interrupted build is never picked up as valid
+        self.write_meta(meta_path, {"frames": frame_count, "size": [size[0], size[1]], "source": source,
+                                    "source_hash": source_hash})
+
+        self.remove_stale(key)
+
+        return self.load(key, size, filename)
+
+    def remove_stale(self, key):
+        # same source file and size but an older cache version
+        prefix = key.rsplit("_", 1)[0] + "_"
+        for filename in os.listdir(self.cache_path):
+            if filename.startswith(prefix) and not filename.startswith(key + "."):
+                try:
+                    os.remove(os.path.join(self.cache_path, filename))
+                except OSError:
+                    traceback.print_exc()
+
+
 def draw_centered_text(text, image, font):
     max_w, _ = image.size
     draw = ImageDraw.Draw(image)
@@ -305,22 +1783,270 @@ def draw_centered_text(text, image, font):
     return image
 
 
+class CaptionCache:
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.captions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, text, font, size):
+        key = (text, font.path, font.size, size[0], size[1])
+
+        with self.lock:
+            caption = self.captions.get(key)
+            if caption is not None:
+                self.captions.move_to_end(key)
+                return caption
+
+        # text is white on black, so one channel is enough to keep
+        image = draw_centered_text(text, Image.new('RGB', (size[0], size[1])), font)
+        caption = np.array(image)[:, :, 0].copy()
+
+        with self.lock:
+            self.captions[key] = caption
+            while len(self.captions) > self.max_size:
+                self.captions.popitem(last=False)
+
+        return caption
+
+
+class FrameMetrics:
+    BUCKETS_MS = (5, 10, 20, 33, 50, 100, 250, 500, 1000)
+
+    def __init__(self, frame_time, metrics_path="", export_interval=10.0):
+        self.frame_time = frame_time
+        self.metrics_path = metrics_path
+        self.export_interval = export_interval
+
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.states = {}
+        self.worst_frame = None
+
+        self.end = threading.Event()
+
+        if self.metrics_path:
+            os.makedirs(self.metrics_path, exist_ok=True)
+            thread = threading.Thread(target=self.run)
+            thread.start()
+
+    def record(self, state_name, render_time, lateness=0.0, dropped_frames=0):
+        render_ms = render_time * 1000
+        with self.lock:
+            state = self.states.get(state_name)
+            if state is None:
+                state = {"frames": 0, "missed_deadlines": 0, "dropped_frames": 0, "max_lateness_ms": 0.0,
+                         "sum_ms": 0.0, "worst_frame": None, "buckets": [0] * (len(self.BUCKETS_MS) + 1)}
+                self.states[state_name] = state
+
+            state["frames"] += 1
+            state["sum_ms"] += render_ms
+            if render_time > self.frame_time:
+                state["missed_deadlines"] += 1
+            state["dropped_frames"] += dropped_frames
+            state["max_lateness_ms"] = max(state["max_lateness_ms"], lateness * 1000)
+
+            bucket_id = len(self.BUCKETS_MS)
+            for i, bucket in enumerate(self.BUCKETS_MS):
+                if render_ms <= bucket:
+                    bucket_id = i
+                    break
+            state["buckets"][bucket_id] += 1
+
+            if state["worst_frame"] is None or render_ms > state["worst_frame"]["render_ms"]:
+                state["worst_frame"] = {"render_ms": render_ms, "time": time.time()}
+            if self.worst_frame is None or render_ms > self.worst_frame["render_ms"]:
+                self.worst_frame = {"render_ms": render_ms, "time": time.time(), "state": state_name}
+
+    def snapshot(self):
+        with self.lock:
+            states = {}
+            for name, state in self.states.items():
+                states[name] = dict(state, buckets=list(state["buckets"]), worst_frame=dict(state["worst_frame"]))
+            return {"uptime_s": time.time() - self.start_time, "frame_budget_ms": self.frame_time * 1000,
+                    "buckets_ms": list(self.BUCKETS_MS), "worst_frame": self.worst_frame, "states": states}
+
+    def to_prometheus(self, snapshot):
+        lines = ["# HELP fotobudka_frame_render_seconds Time to render and present one frame.",
+                 "# TYPE fotobudka_frame_render_seconds histogram"]
+        for name, state in snapshot["states"].items():
+            cumulative = 0
+            for bucket, count in zip(list(self.BUCKETS_MS) + ["+Inf"], state["buckets"]):
+                cumulative += count
+                le = bucket if bucket == "+Inf" else str(bucket / 1000)
+                lines.append('fotobudka_frame_render_seconds_bucket{state="%s",le="%s"} %d' % (name, le, cumulative))
+            lines.append('fotobudka_frame_render_seconds_sum{state="%s"} %f' % (name, state["sum_ms"] / 1000))
+            lines.append('fotobudka_frame_render_seconds_count{state="%s"} %d' % (name, state["frames"]))
+
+        lines.append("# HELP fotobudka_missed_deadlines_total Frames that took longer than the frame budget.")
+        lines.append("# TYPE fotobudka_missed_deadlines_total counter")
+        for name, state in snapshot["states"].items():
+            lines.append('fotobudka_missed_deadlines_total{state="%s"} %d' % (name, state["missed_deadlines"]))
+
+        lines.append("# HELP fotobudka_dropped_frames_total Frame slots skipped by the scheduler to catch up.")
+        lines.append("# TYPE fotobudka_dropped_frames_total counter")
+        for name, state in snapshot["states"].items():
+            lines.append('fotobudka_dropped_frames_total{state="%s"} %d' % (name, state["dropped_frames"]))
+
+        lines.append("# HELP fotobudka_worst_frame_seconds Slowest frame seen since start.")
+        lines.append("# TYPE fotobudka_worst_frame_seconds gauge")
+        for name, state in snapshot["states"].items():
+            lines.append('fotobudka_worst_frame_seconds{state="%s"} %f' % (name,
+                                                                          state["worst_frame"]["render_ms"] / 1000))
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        snapshot = self.snapshot()
+
+        for filename, content in (("frame_metrics.json", json.dumps(snapshot, indent=4)),
+                                  ("frame_metrics.prom", self.to_prometheus(snapshot))):
+            path = os.path.join(self.metrics_path, filename)
+            with open(path + ".tmp", "w") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+
+    def run(self):
+        while not self.end.wait(self.export_interval):
+            try:
+                self.export()
+            except Exception as e:
+                print("Metrics exception occurred: ", str(e))
+                traceback.print_exc()
+
+        try:
+            self.export()
+        except Exception as e:
+            print("Metrics exception occurred: ", str(e))
+            traceback.print_exc()
+
+    def close(self):
+        self.end.set()
+
+
+def check_pair(name, value, minimum):
+    if not isinstance(value, (list, tuple)) or len(value) != 2 or \
+            not all(isinstance(v, int) and not isinstance(v, bool) for v in value):
+        return [name + " has to be two whole numbers, got " + repr(value)]
+    if min(value) < minimum:
+        return [name + " values have to be at least " + str(minimum) + ", got " + repr(value)]
+    return []
+
+
+# a rectangle of a frame, the slices and the cv2 resize target are worked out once
+class Region:
+    def __init__(self, name, pos, size, container_name, container_size):
+        self.name = name
+        self.errors = check_pair(name + " position", pos, 0) + check_pair(name + " size", size, 1)
+        self.slice = None
+        self.size = None
+        if self.errors:
+            return
+
+        x, y = pos
+        w, h = size
+        if x + w > container_size[0] or y + h > container_size[1]:
+            self.errors.append("{} at {} with size {} does not fit in {} of size {}".format(
+                name, tuple(pos), tuple(size), container_name, tuple(container_size)))
+
+        self.pos = (x, y)
+        self.size = (w, h)
+        self.slice = (slice(y, y + h), slice(x, x + w))
+
+    def view(self, frame):
+        return frame[self.slice]
+
+
+class Layout:
+    def __init__(self, size=(1080, 1920), top_text_size=(1060, 400), top_text_pos=(10, 30),
+                 bot_text_size=(1060, 400), bot_text_pos=(10, 1490), frame_preview_size=(1014, 540),
+                 frame_preview_pos=(33, 500), output_image_size=(620, 1748), print_image_size=(1240, 1748),
+                 cropped_img_start=(0, 0), cropped_img_end=(1920, 1080), small_img_size=(573, 343),
+                 small_img_1_pos=(22, 103), small_img_2_pos=(22, 533), small_img_3_pos=(22, 963),
+                 confirm_img_preview_size=(434, 1224), confirm_img_preview_pos=(323, 30),
+                 confirm_text_size=(1060, 600), confirm_text_pos=(10, 1280), camera_size=(2028, 1080)):
+        self.errors = []
+        for name, value in (("window size", size), ("output_image_size", output_image_size),
+                            ("print_image_size", print_image_size), ("camera size", camera_size)):
+            self.errors += check_pair(name, value, 1)
+        if self.errors:
+            return
+
+        self.size = (size[0], size[1])
+        self.width, self.height = self.size
+
+        self.top_text = Region("top_text", top_text_pos, top_text_size, "window", size)
+        self.bot_text = Region("bot_text", bot_text_pos, bot_text_size, "window", size)
+        self.frame_preview = Region("frame_preview", frame_preview_pos, frame_preview_size, "window", size)
+        self.confirm_img_preview = Region("confirm_img_preview", confirm_img_preview_pos, confirm_img_preview_size,
+                                          "window", size)
+        self.confirm_text = Region("confirm_text", confirm_text_pos, confirm_text_size, "window", size)
+
+        # the strip is the left part of the print sheet, the photos go into the strip
+        self.output_image = Region("output_image", (0, 0), output_image_size, "print_image", print_image_size)
+        self.print_image = Region("print_image", (0, 0), print_image_size, "print_image", print_image_size)
+        self.small_imgs = [Region("small_img_" + str(i + 1), pos, small_img_size, "output_image", output_image_size)
+                           for i, pos in enumerate((small_img_1_pos, small_img_2_pos, small_img_3_pos))]
+
+        crop_errors = check_pair("cropped_img_start", cropped_img_start, 0) + \
+            check_pair("cropped_img_end", cropped_img_end, 1)
+        if crop_errors:
+            self.errors += crop_errors
+        else:
+            self.crop = Region("cropped_img", cropped_img_start, (cropped_img_end[0] - cropped_img_start[0],
+                                                                  cropped_img_end[1] - cropped_img_start[1]),
+                               "camera frame", camera_size)
+            self.errors += self.crop.errors
+
+        for region in [self.top_text, self.bot_text, self.frame_preview, self.confirm_img_preview, self.confirm_text,
+                       self.output_image, self.print_image] + self.small_imgs:
+            self.errors += region.errors
+
+    @staticmethod
+    def from_config(data):
+        window = data["main_window"]
+        return Layout(size=window["size"],
+                      top_text_size=window["top_text_size"],
+                      top_text_pos=window["top_text_pos"],
+                      bot_text_size=window["bot_text_size"],
+                      bot_text_pos=window["bot_text_pos"],
+                      frame_preview_size=window["frame_preview_size"],
+                      frame_preview_pos=window["frame_preview_pos"],
+                      output_image_size=window["output_image_size"],
+                      print_image_size=window["print_image_size"],
+                      cropped_img_start=window["cropped_img_start"],
+                      cropped_img_end=window["cropped_img_end"],
+                      small_img_size=window["small_img_size"],
+                      small_img_1_pos=window["small_img_1_pos"],
+                      small_img_2_pos=window["small_img_2_pos"],
+                      small_img_3_pos=window["small_img_3_pos"],
+                      confirm_img_preview_size=window["confirm_img_preview_size"],
+                      confirm_img_preview_pos=window["confirm_img_preview_pos"],
+                      confirm_text_size=window["confirm_text_size"],
+                      confirm_text_pos=window["confirm_text_pos"],
+                      camera_size=data["camera"]["size"])
+
+
 class MainWindow:
     def __init__(self, camera_control: CameraControl, flash_control: FlashControl, printer: PrinterControl,
-                 size=(1080, 1920), fps=30, home_file="resources/fotobudka_home.mp4",
-                 countdown_file="resources/countdown_675_1080_reduced.mp4", top_text_size=(1060, 400),
-                 top_text_pos=(10, 30), bot_text_size=(1060, 400), bot_text_pos=(10, 1490),
-                 frame_preview_size=(1014, 540), frame_preview_pos=(33, 500), frame_preview_timeout=2.0,
+                 layout: Layout = None, fps=30, home_file="resources/fotobudka_home.mp4",
+                 countdown_file="resources/countdown_675_1080_reduced.mp4", frame_preview_timeout=2.0,
                  font="resources/tahoma_font.ttf", font_size=130,
                  output_image_background_filename="resources/pasek.png",
-                 print_background_filename="resources/print_background.png", output_image_size=(620, 1748),
-                 print_image_size=(1240, 1748), cropped_img_start=(0, 0), cropped_img_end=(1920, 1080),
-                 small_img_size=(573, 343), small_img_1_pos=(22, 103),
-                 small_img_2_pos=(22, 533), small_img_3_pos=(22, 963), confirm_img_preview_size=(434, 1224),
-                 confirm_img_preview_pos=(323, 30), confirm_text_size=(1060, 600), confirm_text_pos=(10, 1280),
-                 confirm_text_font_size=100, default_how_many_prints=2, max_prints=4, print_confirm_timeout=15,
+                 print_background_filename="resources/print_background.png", confirm_text_font_size=100,
+                 default_how_many_prints=2, max_prints=4, print_confirm_timeout=15,
                  save_path="saved_images", increase_preview_brightness=True, preview_contrast_value=3,
-                 preview_brightness_value=10, show_sleep_time=True, disable_fullscreen=False, size_down_view=False):
+                 preview_brightness_value=10, show_sleep_time=True, disable_fullscreen=False, size_down_view=False,
+                 stream_videos=False, video_frame_budget=30, realtime_video=True, use_frame_cache=False,
+                 frame_cache_path="cache", image_writer_threads=2, image_writer_queue_size=16, caption_cache_size=64,
+                 metrics_path="", metrics_export_interval=10.0, display=None, idle_wait_millis=100,
+                 post_process_workers=0, photo_timeout=5.0, printer_wait_timeout=30.0, session_catalog_path="",
+                 thumbnail_sizes=(), thumbnail_quality=85):
+
+        if layout is None:
+            layout = Layout()
+        if layout.errors:
+            raise ValueError("Wrong layout: " + "; ".join(layout.errors))
+        self.layout = layout
 
         now = datetime.now()
 
@@ -334,42 +2060,34 @@ class MainWindow:
 
         self.current_state = States.HOME
 
-        self.width = size[0]
-        self.height = size[1]
+        self.width, self.height = layout.size
+        self.size_down_size = (int(self.width / 2), int(self.height / 2))
 
         self.show_sleep_time = show_sleep_time
 
-        self.top_text_pos = top_text_pos
-        self.bot_text_pos = bot_text_pos
-        self.top_text_size = top_text_size
-        self.bot_text_size = bot_text_size
-
-        self.frame_preview_size = frame_preview_size
-        self.frame_preview_pos = frame_preview_pos
-
-        self.confirm_image_preview_pos = confirm_img_preview_pos
-        self.confirm_image_preview_size = confirm_img_preview_size
-
-        self.confirm_text_pos = confirm_text_pos
-        self.confirm_text_size = confirm_text_size
-
-        self.empty_image_top_text = Image.new('RGB', self.top_text_size)
-        self.empty_image_bot_text = Image.new('RGB', self.bot_text_size)
-        self.empty_image_confirm_text = Image.new('RGB', self.confirm_text_size)
-
         self.empty_background = np.zeros((self.height, self.width, 3), np.uint8)
 
         self.font = ImageFont.truetype(font, font_size)
         self.confirm_font = ImageFont.truetype(font, confirm_text_font_size)
+        self.caption_cache = CaptionCache(caption_cache_size)
 
-        self.home_resource, self.home_resource_size = self.read_file(home_file)
-        self.home_resource_id = 0
+        self.stream_videos = stream_videos
+        self.video_frame_budget = video_frame_budget
+        self.realtime_video = realtime_video
 
-        self.countdown_resource, self.countdown_resource_size = self.read_file(countdown_file)
-        self.countdown_resource_id = 0
+        self.frame_cache = None
+        if use_frame_cache:
+            if stream_videos:
+                # the cached frames are already paged in on demand, the videos are not streamed on top of that
+                print("Both stream_videos and use_frame_cache are set, videos are read from the frame cache!")
+            self.frame_cache = FrameCache(frame_cache_path)
 
         self.fps = fps
 
+        self.home_resource = self.read_file(home_file)
+        self.countdown_resource = self.read_file(countdown_file)
+        self.frame_metrics = FrameMetrics(1.0 / fps, metrics_path, metrics_export_interval)
+
         self.frame_preview_time_start = time.time()
         self.frame_preview_timeout = frame_preview_timeout
 
@@ -377,27 +2095,21 @@ class MainWindow:
         self.flash_control = flash_control
 
         self.photo_main_screen = None
+        self.photo_request = None
+        self.photo_request_time = 0.0
+        self.photo_timeout = photo_timeout
 
         self.frame_1 = None
         self.frame_2 = None
         self.frame_3 = None
 
-        self.output_image_background = cv2.resize(cv2.imread(output_image_background_filename), output_image_size)
+        self.output_image_background = self.read_image(output_image_background_filename, layout.output_image.size)
         self.output_image = None
 
-        self.print_background = cv2.resize(cv2.imread(print_background_filename), print_image_size)
-        self.print_image_size = print_image_size
+        self.print_background = self.read_image(print_background_filename, layout.print_image.size)
         self.print_image = None
         self.print_image_path = ""
 
-        self.cropped_img_start = cropped_img_start
-        self.cropped_img_end = cropped_img_end
-
-        self.small_img_1_pos = small_img_1_pos
-        self.small_img_2_pos = small_img_2_pos
-        self.small_img_3_pos = small_img_3_pos
-        self.small_img_size = small_img_size
-
         self.top_texts = ["Rewelacyjnie!", "Czadowo!", "Gitówa!", "Całkiem, całkiem!", "Pięknie!", 'Bomba!', 'Sztos!']
         self.bot_texts = ["Nadchodzi", "Teraz", "Przybywa", "Już za chwilę", "Trzy, dwa, jeden", "Wkracza", "Wskakuje",
                           "Wlatuje"]
@@ -409,23 +2121,58 @@ class MainWindow:
         self.how_many_prints = self.default_how_many_prints
         self.max_prints = max_prints
         self.print_confirm_timeout = print_confirm_timeout
+        self.printer_wait_timeout = printer_wait_timeout
         self.update_print_screen = False
 
         self.save_id = 0
 
+        # the writer threads start only after every resource file has been read, a missing file exits right away
+        self.session_catalog = None
+        if session_catalog_path:
+            self.session_catalog = SessionCatalog(session_catalog_path)
+            self.printer.add_job_listener(self.on_print_job_done)
+
+        self.thumbnail_writer = None
+        if thumbnail_sizes:
+            self.thumbnail_writer = ThumbnailWriter(thumbnail_sizes, thumbnail_quality)
+
+        self.image_writer = ImageWriter(image_writer_threads, image_writer_queue_size)
+        self.print_lock = threading.Lock()
+        self.print_image_status = "saving"
+        self.pending_prints = 0
+
         self.increase_preview_brightness = increase_preview_brightness
         self.preview_contrast_value = preview_contrast_value
         self.preview_brightness_value = preview_brightness_value
 
+        self.post_processor = PostProcessor(post_process_workers, self.output_image_background,
+                                            self.print_background, layout, camera_control.frame_pool,
+                                            increase_preview_brightness, preview_contrast_value,
+                                            preview_brightness_value, self.image_writer)
+        self.confirm_preview = None
+        self.post_processing_pending = False
+        # frame buffers handed over by the camera, they go back when the post processor is done with the session
+        self.photo_buffer_ids = []
+
         self.disable_fullscreen = disable_fullscreen
         self.size_down_view = size_down_view
 
+        self.end = threading.Event()
+
+        self.prerender_captions()
+        # shown while the camera takes the photo, a white screen also lights up faces
+        self.smile_screen = cv2.bitwise_not(self.generate_photo_main_screen("Uśmiech!", None, None))
+        self.camera_error_screen = self.generate_photo_main_screen("Kamera nie\ndziała!", None, None)
+        self.saving_screen = self.generate_photo_main_screen("Zapisuję\nzdjęcia...", None, None)
+
         self.last_use_time = time.time()
 
-        if not self.disable_fullscreen:
-            _ = cv2.namedWindow("window", cv2.WND_PROP_FULLSCREEN)
-            cv2.moveWindow("window", 0, 0)
-            cv2.setWindowProperty("window", cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+        self.idle_wait_millis = idle_wait_millis
+        self.presented_frame = None
+
+        self.display = display
+        if self.display is None:
+            self.display = OpenCVDisplay(not self.disable_fullscreen)
 
         self.reset()
 
@@ -444,9 +2191,25 @@ class MainWindow:
 
         self.output_image = None
         self.print_image = None
+        self.confirm_preview = None
+        self.post_processing_pending = False
+
+        # the photos are released only after their previews, composition and saved files are done with them
+        photo_buffer_ids = self.photo_buffer_ids
+        self.photo_buffer_ids = []
+        self.post_processor.next_session(lambda: self.release_photo_buffers(photo_buffer_ids))
+
+        if self.photo_request is not None:
+            # the session ended with a photo on the way, its buffer goes straight back when it arrives
+            self.photo_request.add_done_callback(self.release_photo_buffer)
+            self.photo_request = None
 
         self.save_id += 1
 
+        with self.print_lock:
+            self.print_image_status = "saving"
+            self.pending_prints = 0
+
         self.current_texts_bot_id.clear()
         self.current_texts_top_id.clear()
 
@@ -463,12 +2226,21 @@ class MainWindow:
                 self.current_texts_top_id.append(text_id)
 
     def run(self):
-        rate = Rate(self.fps)
+        scheduler = FrameScheduler(self.fps)
         frame = self.empty_background.copy()
-        while True:
+        while not self.end.is_set():
             try:
+                tick_start = time.perf_counter()
+                tick_state = self.current_state
+                self.camera_control.set_mode(self.get_camera_mode())
+
                 if self.current_state == States.HOME:
                     frame = self.handle_home()
+                    if not self.camera_control.ready.is_set() and self.camera_control.setup_error is not None:
+                        frame = self.camera_error_screen
+                    elif not self.post_processor.start_session():
+                        # every buffer still holds a session that is being saved, the button waits for it
+                        frame = self.saving_screen
 
                 elif self.current_state == States.PREPARE:
                     if self.photo_main_screen is None:
@@ -482,69 +2254,77 @@ class MainWindow:
                         self.current_state = States.COUNTDOWN_1
 
                 elif self.current_state == States.PHOTO_1:
-                    if self.photo_main_screen is None:
-                        self.photo_main_screen = self.generate_photo_main_screen(
-                            self.top_texts[self.current_texts_top_id[1]],
-                            self.bot_texts[self.current_texts_bot_id[1]]
-                            + "\nZdjęcie nr 2", self.frame_1.copy())
-                    frame = self.photo_main_screen
+                    frame = self.get_photo_screen(self.top_texts[self.current_texts_top_id[1]],
+                                                  self.bot_texts[self.current_texts_bot_id[1]] + "\nZdjęcie nr 2", 0)
 
                     if time.time() - self.frame_preview_time_start > self.frame_preview_timeout:
                         self.current_state = States.COUNTDOWN_2
 
                 elif self.current_state == States.PHOTO_2:
-                    if self.photo_main_screen is None:
-                        self.photo_main_screen = self.generate_photo_main_screen(
-                            self.top_texts[self.current_texts_top_id[2]],
-                            self.bot_texts[self.current_texts_bot_id[2]]
-                            + "\nZdjęcie nr 3", self.frame_2.copy())
-                    frame = self.photo_main_screen
+                    frame = self.get_photo_screen(self.top_texts[self.current_texts_top_id[2]],
+                                                  self.bot_texts[self.current_texts_bot_id[2]] + "\nZdjęcie nr 3", 1)
 
                     if time.time() - self.frame_preview_time_start > self.frame_preview_timeout:
                         self.current_state = States.COUNTDOWN_3
 
                 elif self.current_state == States.PHOTO_3:
-                    if self.photo_main_screen is None:
-                        self.photo_main_screen = self.generate_photo_main_screen(
-                            self.top_texts[self.current_texts_top_id[3]],
-                            None, self.frame_3.copy())
-                    frame = self.photo_main_screen
+                    frame = self.get_photo_screen(self.top_texts[self.current_texts_top_id[3]], None, 2)
+
                     if time.time() - self.frame_preview_time_start > self.frame_preview_timeout / 2:
-                        self.generate_output_image()
-                        self.save_images()
-                        self.photo_main_screen = None
-                        self.current_state = States.CONFIRM_PRINT
-                        self.frame_preview_time_start = time.time()
+                        # the strip was started when the last photo arrived, it is usually ready by now
+                        if self.collect_output_image():
+                            self.save_images()
+                            self.photo_main_screen = None
+                            self.current_state = States.CONFIRM_PRINT
+                            self.frame_preview_time_start = time.time()
 
                 elif self.current_state == States.COUNTDOWN_1 or self.current_state == States.COUNTDOWN_2 or \
                         self.current_state == States.COUNTDOWN_3:
-                    frame, done = self.handle_countdown()
-
-                    if done:
-                        self.camera_control.start_photo()
-
-                        while not self.camera_control.is_done():
-                            time.sleep(0.05)
-
-                        if self.current_state == States.COUNTDOWN_1:
-                            self.frame_1 = self.camera_control.get_photo()
-                            self.current_state = States.PHOTO_1
-                        elif self.current_state == States.COUNTDOWN_2:
-                            self.frame_2 = self.camera_control.get_photo()
-                            self.current_state = States.PHOTO_2
-                        elif self.current_state == States.COUNTDOWN_3:
-                            self.frame_3 = self.camera_control.get_photo()
-                            self.current_state = States.PHOTO_3
+                    if self.photo_request is None:
+                        frame, done = self.handle_countdown()
+
+                        if done:
+                            self.photo_request = self.camera_control.start_photo()
+                            self.photo_request_time = time.time()
+                            self.countdown_resource.rewind()
+                            frame = self.smile_screen
+                    else:
+                        frame = self.smile_screen
 
-                        self.frame_preview_time_start = time.time()
-                        self.countdown_resource_id = 0
-                        self.photo_main_screen = None
+                    if self.photo_request is not None and not self.photo_request.is_done() and \
+                            time.time() - self.photo_request_time > self.photo_timeout:
+                        print("Photo not taken in", self.photo_timeout, "s, ending the session")
+                        self.reset()
+                    elif self.photo_request is not None and self.photo_request.is_done():
+                        try:
+                            self.photo_request.result()
+                        except Exception as e:
+                            print("Could not take the photo: ", str(e))
+                            self.photo_request = None
+                            self.reset()
+                        else:
+                            buffer_id = self.photo_request.buffer_id
+                            self.photo_buffer_ids.append(buffer_id)
+                            self.photo_request = None
+
+                            if self.current_state == States.COUNTDOWN_1:
+                                self.frame_1 = self.post_processor.add_photo(0, buffer_id)
+                                self.current_state = States.PHOTO_1
+                            elif self.current_state == States.COUNTDOWN_2:
+                                self.frame_2 = self.post_processor.add_photo(1, buffer_id)
+                                self.current_state = States.PHOTO_2
+                            elif self.current_state == States.COUNTDOWN_3:
+                                self.frame_3 = self.post_processor.add_photo(2, buffer_id)
+                                self.generate_output_image()
+                                self.current_state = States.PHOTO_3
+
+                            self.frame_preview_time_start = time.time()
+                            self.photo_main_screen = None
 
                 elif self.current_state == States.CONFIRM_PRINT:
                     if self.photo_main_screen is None:
-                        self.photo_main_screen = self.generate_photo_confirm_screen \
-                            ("Wciśnij przycisk,\naby wydrukować!\nPoczekaj " + str(self.print_confirm_timeout) +
-                             " sekund,\naby anulować!", self.output_image.copy())
+                        self.photo_main_screen = self.generate_photo_confirm_screen(self.get_confirm_text(),
+                                                                                    self.confirm_preview)
 
                     frame = self.photo_main_screen
 
@@ -553,32 +2333,55 @@ class MainWindow:
 
                 elif self.current_state == States.PRINT:
                     if self.photo_main_screen is None or self.update_print_screen or self.printer.changed():
-                        text = "Wciśnij przycisk,\naby wydrukować\nwięcej kopii!\nDrukuję " + \
-                               str(self.how_many_prints - self.printer.get_print_size()) + " z " + \
-                               str(self.how_many_prints) + "..."
-
-                        self.photo_main_screen = self.generate_photo_confirm_screen(text, self.output_image.copy())
+                        if self.printer.ready.is_set():
+                            text = self.get_print_text(
+                                self.how_many_prints - self.printer.get_print_size() - self.pending_prints,
+                                self.how_many_prints)
+                        else:
+                            text = self.get_printer_wait_text()
+
+                        self.photo_main_screen = self.generate_photo_confirm_screen(text, self.confirm_preview)
                         self.update_print_screen = False
 
                     frame = self.photo_main_screen
 
-                    if self.printer.is_done():
+                    if self.printer.is_done() and self.pending_prints == 0:
+                        self.reset()
+                    elif not self.printer.ready.is_set() and \
+                            time.time() - self.frame_preview_time_start > self.printer_wait_timeout:
+                        # the prints stay queued and come out once the printer shows up
+                        print("No printer after", self.printer_wait_timeout, "s, going back home")
                         self.reset()
 
-                if self.show_sleep_time:
-                    sleep_millis = rate.get_remaining_time_millis_cv2()
-                    empty = np.zeros((40, 40, 3), np.uint8)
-                    frame[:40, :40] = empty
-                    cv2.putText(frame, str(sleep_millis), (5, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 1, 2)
-
-                if self.size_down_view:
-                    frame = cv2.resize(frame, (int(self.width / 2), int(self.height / 2)))
-                cv2.imshow("window", frame)
-
-                sleep_millis = rate.get_remaining_time_millis_cv2()
+                # static screens are the same object tick after tick, only present frames that changed
+                presented = frame is not self.presented_frame
+                if presented:
+                    self.presented_frame = frame
+
+                    if self.show_sleep_time:
+                        # draw on a copy, frame may be a cached screen or a read-only cache page
+                        frame = frame.copy()
+                        sleep_millis = scheduler.get_remaining_millis()
+                        empty = np.zeros((40, 40, 3), np.uint8)
+                        frame[:40, :40] = empty
+                        cv2.putText(frame, str(sleep_millis), (5, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255),
+                                    1, 2)
+
+                    if self.size_down_view:
+                        frame = cv2.resize(frame, self.size_down_size)
+                    self.display.show(frame)
+                render_time = time.perf_counter() - tick_start
+
+                if presented or self.photo_request is not None or self.post_processing_pending:
+                    # pending photos and post processing are checked every tick, so results show as soon as they come
+                    key = self.display.wait_key(scheduler.get_remaining_millis())
+                    scheduler.tick()
+                else:
+                    # nothing to redraw, wait longer, a key press still ends the wait right away
+                    key = self.display.wait_key(max(scheduler.get_remaining_millis(), self.idle_wait_millis))
+                    scheduler.restart()
 
-                key = cv2.waitKey(sleep_millis)
-                rate.update_last_time()
+                self.frame_metrics.record(tick_state.name, render_time, scheduler.lateness, scheduler.dropped_frames)
 
                 if key == ord("q"):
                     print("Closing!")
@@ -590,6 +2393,54 @@ class MainWindow:
                 print("Main window exception occurred: ", str(e))
                 traceback.print_exc()
 
+    def close(self):
+        self.end.set()
+        self.photo_request = None
+        self.home_resource.close()
+        self.countdown_resource.close()
+        self.post_processor.close()
+        self.image_writer.close()
+        self.frame_metrics.close()
+        if self.session_catalog is not None:
+            self.session_catalog.close()
+        if self.thumbnail_writer is not None:
+            self.thumbnail_writer.close()
+
+    def get_confirm_text(self):
+        return "Wciśnij przycisk,\naby wydrukować!\nPoczekaj " + str(self.print_confirm_timeout) + \
+            " sekund,\naby anulować!"
+
+    def get_printer_wait_text(self):
+        return "Czekam na\ndrukarkę..."
+
+    def get_print_text(self, printing, how_many_prints):
+        return "Wciśnij przycisk,\naby wydrukować\nwięcej kopii!\nDrukuję " + str(printing) + " z " + \
+            str(how_many_prints) + "..."
+
+    def prerender_captions(self):
+        self.caption_cache.get("Przygotuj się do\nzdjęcia!", self.font, self.layout.top_text.size)
+
+        for text in self.top_texts:
+            self.caption_cache.get(text, self.font, self.layout.top_text.size)
+
+        for photo_number in range(1, 4):
+            for text in self.bot_texts:
+                self.caption_cache.get(text + "\nZdjęcie nr " + str(photo_number), self.font,
+                                       self.layout.bot_text.size)
+
+        self.caption_cache.get(self.get_confirm_text(), self.confirm_font, self.layout.confirm_text.size)
+        self.caption_cache.get(self.get_printer_wait_text(), self.confirm_font, self.layout.confirm_text.size)
+
+        for how_many_prints in range(self.default_how_many_prints, self.max_prints + 1):
+            for printing in range(how_many_prints + 1):
+                self.caption_cache.get(self.get_print_text(printing, how_many_prints), self.confirm_font,
+                                       self.layout.confirm_text.size)
+
+    def get_camera_mode(self):
+        if States.PREPARE <= self.current_state <= States.COUNTDOWN_3:
+            return CameraModes.WARM
+        return CameraModes.IDLE
+
     def generate_photo_confirm_screen(self, bot_text, preview):
         frame = self.empty_background.copy()
         frame = self.set_bot_text_confirm(frame, bot_text)
@@ -598,48 +2449,104 @@ class MainWindow:
         return frame
 
     def generate_output_image(self):
-        self.output_image = self.output_image_background.copy()
-
-        crop_s_x = self.cropped_img_start[0]
-        crop_e_x = self.cropped_img_end[0]
-        crop_s_y = self.cropped_img_start[1]
-        crop_e_y = self.cropped_img_end[1]
-        cropped_frame_1 = self.frame_1[crop_s_y:crop_e_y, crop_s_x:crop_e_x]
-        cropped_frame_2 = self.frame_2[crop_s_y:crop_e_y, crop_s_x:crop_e_x]
-        cropped_frame_3 = self.frame_3[crop_s_y:crop_e_y, crop_s_x:crop_e_x]
+        self.post_processor.compose()
 
-        w = self.small_img_size[0]
-        h = self.small_img_size[1]
+    def on_post_process_error(self, message, e):
+        print(message, str(e))
+        traceback.print_exc()
+        if isinstance(e, BrokenProcessPool):
+            self.post_processor.restart_executor()
+        self.reset()
 
-        x1 = self.small_img_1_pos[0]
-        x2 = self.small_img_2_pos[0]
-        x3 = self.small_img_3_pos[0]
-        y1 = self.small_img_1_pos[1]
-        y2 = self.small_img_2_pos[1]
-        y3 = self.small_img_3_pos[1]
+    def collect_output_image(self):
+        try:
+            composition = self.post_processor.get_composition()
+        except Exception as e:
+            self.on_post_process_error("Could not compose the output image: ", e)
+            return False
 
-        f1 = cv2.resize(cropped_frame_1, (w, h))
-        f2 = cv2.resize(cropped_frame_2, (w, h))
-        f3 = cv2.resize(cropped_frame_3, (w, h))
+        self.post_processing_pending = composition is None
+        if composition is None:
+            return False
 
-        self.output_image[y1:y1 + h, x1:x1 + w] = f1
-        self.output_image[y2:y2 + h, x2:x2 + w] = f2
-        self.output_image[y3:y3 + h, x3:x3 + w] = f3
+        self.output_image, self.print_image, self.confirm_preview = composition
+        return True
 
-        self.print_image = self.print_background.copy()
-        self.print_image[0:self.print_image_size[1], 0:int(self.print_image_size[0] / 2)] = self.output_image
+    def get_photo_screen(self, top_text, bot_text, photo_id):
+        if self.photo_main_screen is None:
+            try:
+                preview = self.post_processor.get_preview(photo_id)
+            except Exception as e:
+                self.on_post_process_error("Could not make the photo preview: ", e)
+                return self.smile_screen
+            self.post_processing_pending = preview is None
+            if preview is None:
+                # the preview is still being made, the smile screen stays up
+                return self.smile_screen
+            self.photo_main_screen = self.generate_photo_main_screen(top_text, bot_text, preview)
+        return self.photo_main_screen
+
+    def release_photo_buffer(self, request):
+        if request.buffer_id is not None:
+            self.camera_control.frame_pool.release(request.buffer_id)
+
+    def release_photo_buffers(self, buffer_ids):
+        for buffer_id in buffer_ids:
+            self.camera_control.frame_pool.release(buffer_id)
 
     def save_images(self):
         save_path = os.path.join(self.images_save_path, str(self.save_id))
-        os.makedirs(save_path, exist_ok=True)
-        cv2.imwrite(os.path.join(save_path, "1.png"), self.frame_1)
-        cv2.imwrite(os.path.join(save_path, "2.png"), self.frame_2)
-        cv2.imwrite(os.path.join(save_path, "3.png"), self.frame_3)
-        cv2.imwrite(os.path.join(save_path, "pasek.png"), self.output_image)
-
         self.print_image_path = os.path.join(save_path, "print.png")
-        cv2.imwrite(self.print_image_path, self.print_image)
-        print("Saved images!")
+
+        # print image goes first, it is the only one somebody may be waiting for
+        images = [(self.print_image_path, "print"),
+                  (os.path.join(save_path, "pasek.png"), "strip"),
+                  (os.path.join(save_path, "1.png"), "0"),
+                  (os.path.join(save_path, "2.png"), "1"),
+                  (os.path.join(save_path, "3.png"), "2")]
+
+        save_id = self.save_id
+        self.post_processor.save(images, lambda success: self.on_images_saved(save_id, success))
+
+    def on_images_saved(self, save_id, success):
+        with self.print_lock:
+            current = save_id == self.save_id
+
+            session_path = os.path.join(self.images_save_path, str(save_id))
+            # only queued here, before the session is marked ready, so later print counts land on an existing row
+            if self.session_catalog is not None:
+                self.session_catalog.add_session(session_path, "saved" if success else "failed",
+                                                 print_count=self.pending_prints if current and success else 0)
+
+            if self.thumbnail_writer is not None and success:
+                self.thumbnail_writer.add(session_path)
+
+            if not current:
+                return
+
+            if success:
+                print("Saved images!")
+                self.print_image_status = "ready"
+                if self.pending_prints > 0:
+                    self.printer.add(self.print_image_path, self.pending_prints)
+            else:
+                print("Could not save images, printing cancelled!")
+                self.print_image_status = "failed"
+
+            self.pending_prints = 0
+            self.update_print_screen = True
+
+    def request_prints(self, count):
+        with self.print_lock:
+            if self.print_image_status == "ready":
+                self.printer.add(self.print_image_path, count)
+                if self.session_catalog is not None:
+                    self.session_catalog.add_prints(self.print_image_path, count)
+            elif self.print_image_status == "saving":
+                self.pending_prints += count
+
+    def on_print_job_done(self, filename, copies, state, printed):
+        self.session_catalog.add_printed(filename, printed, state.name)
 
     def generate_photo_main_screen(self, top_text, bot_text, preview):
         frame = self.empty_background.copy()
@@ -653,63 +2560,30 @@ class MainWindow:
         return frame
 
     def set_bot_text_confirm(self, frame, text):
-        image = draw_centered_text(text, self.empty_image_confirm_text.copy(), self.confirm_font)
-        cv2_im_processed = np.array(image)
-        x0 = self.confirm_text_pos[0]
-        x1 = self.confirm_text_size[0] + self.confirm_text_pos[0]
-        y0 = self.confirm_text_pos[1]
-        y1 = self.confirm_text_size[1] + self.confirm_text_pos[1]
-        frame[y0:y1, x0:x1] = cv2_im_processed
+        caption = self.caption_cache.get(text, self.confirm_font, self.layout.confirm_text.size)
+        frame[self.layout.confirm_text.slice] = caption[:, :, None]
 
         return frame
 
     def set_confirm_frame_preview(self, frame, preview):
-        x0 = self.confirm_image_preview_pos[0]
-        x1 = self.confirm_image_preview_size[0] + self.confirm_image_preview_pos[0]
-        y0 = self.confirm_image_preview_pos[1]
-        y1 = self.confirm_image_preview_size[1] + self.confirm_image_preview_pos[1]
-        preview = cv2.resize(preview, self.confirm_image_preview_size)
-
-        if self.increase_preview_brightness:
-            preview = self.change_brightness(preview, self.preview_contrast_value, self.preview_brightness_value)
-
-        frame[y0:y1, x0:x1] = preview
+        frame[self.layout.confirm_img_preview.slice] = preview
 
         return frame
 
     def set_bot_text(self, frame, text):
-        image = draw_centered_text(text, self.empty_image_bot_text.copy(), self.font)
-        cv2_im_processed = np.array(image)
-        x0 = self.bot_text_pos[0]
-        x1 = self.bot_text_size[0] + self.bot_text_pos[0]
-        y0 = self.bot_text_pos[1]
-        y1 = self.bot_text_size[1] + self.bot_text_pos[1]
-        frame[y0:y1, x0:x1] = cv2_im_processed
+        caption = self.caption_cache.get(text, self.font, self.layout.bot_text.size)
+        frame[self.layout.bot_text.slice] = caption[:, :, None]
 
         return frame
 
     def set_top_text(self, frame, text):
-        image = draw_centered_text(text, self.empty_image_top_text.copy(), self.font)
-        cv2_im_processed = np.array(image)
-        x0 = self.top_text_pos[0]
-        x1 = self.top_text_size[0] + self.top_text_pos[0]
-        y0 = self.top_text_pos[1]
-        y1 = self.top_text_size[1] + self.top_text_pos[1]
-        frame[y0:y1, x0:x1] = cv2_im_processed
+        caption = self.caption_cache.get(text, self.font, self.layout.top_text.size)
+        frame[self.layout.top_text.slice] = caption[:, :, None]
 
         return frame
 
     def set_frame_preview(self, frame, preview):
-        x0 = self.frame_preview_pos[0]
-        x1 = self.frame_preview_size[0] + self.frame_preview_pos[0]
-        y0 = self.frame_preview_pos[1]
-        y1 = self.frame_preview_size[1] + self.frame_preview_pos[1]
-        preview = cv2.resize(preview, self.frame_preview_size)
-
-        if self.increase_preview_brightness:
-            preview = self.change_brightness(preview, self.preview_contrast_value, self.preview_brightness_value)
-
-        frame[y0:y1, x0:x1] = preview
+        frame[self.layout.frame_preview.slice] = preview
 
         return frame
 
@@ -717,6 +2591,15 @@ class MainWindow:
         print("Button click")
 
         if self.current_state == States.HOME:
+            if not self.camera_control.ready.is_set():
+                # still starting up, the home screen is already shown while the camera is configured
+                print("Camera not ready yet!")
+                return
+
+            if not self.post_processor.start_session():
+                print("Previous sessions are still being saved!")
+                return
+
             if time.time() - self.last_use_time > 600:
                 self.flash_control.start_flash()
                 time.sleep(0.5)
@@ -727,41 +2610,23 @@ class MainWindow:
             self.frame_preview_time_start = time.time()
         elif self.current_state == States.CONFIRM_PRINT:
             self.current_state = States.PRINT
-            for _ in range(self.how_many_prints):
-                self.printer.add(self.print_image_path)
+            self.frame_preview_time_start = time.time()
+            self.request_prints(self.how_many_prints)
             self.photo_main_screen = None
 
         elif self.current_state == States.PRINT:
             if self.how_many_prints < self.max_prints:
                 print("Print more!")
-                self.printer.add(self.print_image_path)
+                self.request_prints(1)
                 self.how_many_prints += 1
                 self.update_print_screen = True
 
-    def change_brightness(self, img, alpha, beta):
-        return cv2.addWeighted(img, alpha, np.zeros(img.shape, img.dtype), 0, beta)
-
     def handle_home(self):
-        if self.home_resource_size == 1:
-            return self.home_resource
-        else:
-            resource = self.home_resource[self.home_resource_id]
-
-            if self.home_resource_id < self.home_resource_size - 1:
-                self.home_resource_id += 1
-            else:
-                self.home_resource_id = 0
-
-            return resource
+        resource, _ = self.home_resource.read()
+        return resource
 
     def handle_countdown(self):
-        done = False
-        resource = self.countdown_resource[self.countdown_resource_id]
-
-        if self.countdown_resource_id < self.countdown_resource_size - 1:
-            self.countdown_resource_id += 1
-        else:
-            done = True
+        resource, done = self.countdown_resource.read()
         return resource, done
 
     def read_file(self, filename):
@@ -775,27 +2640,54 @@ class MainWindow:
             exit(0)
         else:
             if values[1] in img_types:
-                img = cv2.imread(filename)
-                img = cv2.resize(img, (self.width, self.height))
-                return img, 1
+                resource = FrameSequence([self.read_image(filename, (self.width, self.height))])
+                fps = self.fps
             elif values[1] in video_types:
-                images = []
-                cap = cv2.VideoCapture(filename)
-
-                while cap.isOpened():
-                    ret, img = cap.read()
-                    if ret:
-                        img = cv2.resize(img, (self.width, self.height))
-                        images.append(img)
-                    else:
-                        break
-                return images, len(images)
+                if self.frame_cache is not None:
+                    resource = FrameSequence(self.frame_cache.get(filename, (self.width, self.height),
+                                                                  lambda: self.decode_video(filename)))
+                elif self.stream_videos:
+                    resource = VideoStream(filename, (self.width, self.height), self.video_frame_budget)
+                else:
+                    resource = FrameSequence(list(self.decode_video(filename)))
+                fps = self.read_video_fps(filename)
 
             else:
                 print("Wrong file format for: " + filename + " Available formats: " + str(img_types) + ", "
                       + str(video_types))
                 exit(0)
 
+            if self.realtime_video:
+                return PlaybackClock(resource, fps)
+            return resource
+
+    def read_video_fps(self, filename):
+        cap = cv2.VideoCapture(filename)
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        cap.release()
+
+        if not fps > 0:
+            print("No frame rate in " + filename + ", playing at " + str(self.fps) + " fps")
+            return self.fps
+        return fps
+
+    def read_image(self, filename, size):
+        if self.frame_cache is not None:
+            return self.frame_cache.get(filename, size, lambda: [cv2.resize(cv2.imread(filename), size)])[0]
+        return cv2.resize(cv2.imread(filename), size)
+
+    def decode_video(self, filename):
+        cap = cv2.VideoCapture(filename)
+
+        while cap.isOpened():
+            ret, img = cap.read()
+            if ret:
+                img = cv2.resize(img, (self.width, self.height))
+                yield img
+            else:
+                break
+        cap.release()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Fotobudka',
@@ -807,16 +2699,48 @@ if __name__ == "__main__":
     data = json.load(f)
     f.close()
 
+    # a bad region would only show up as a numpy broadcast error in the middle of a session
+    layout = Layout.from_config(data)
+    if layout.errors:
+        print("Wrong layout in " + args.config + ":")
+        for error in layout.errors:
+            print("  " + error)
+        exit(0)
+
     if not data["flash"]["disable_flash"]:
         import RPi.GPIO as GPIO
 
+    if not data["printer"]["disable_printer"]:
+        import cups
+
+    # the camera, flash and printer finish their setup in their own threads while the videos are decoded here,
+    # the home screen comes up once the display and the videos are ready
+    boot = BootReport()
+
+    boot.begin("display")
+    display = create_display(display_backend=data["main_window"]["display_backend"],
+                             fullscreen=not data["main_window"]["disable_fullscreen"],
+                             framebuffer_device=data["main_window"]["framebuffer_device"],
+                             input_device=data["main_window"]["input_device"],
+                             framebuffer_rotation=data["main_window"]["framebuffer_rotation"])
+    boot.done("display")
+
+    boot.begin("printer")
     printerControl = PrinterControl(wait_for_print=data["printer"]["wait_for_print"],
-                                    disable_printer=data["printer"]["disable_printer"])
+                                    disable_printer=data["printer"]["disable_printer"],
+                                    job_poll_interval=data["printer"]["job_poll_interval"],
+                                    fake_print_time=data["printer"]["fake_print_time"],
+                                    connect_retry_interval=data["printer"]["connect_retry_interval"])
+    boot.watch("printer", printerControl)
 
+    boot.begin("flash")
     flashControl = FlashControl(gpio_pin=data["flash"]["gpio_pin"],
                                 sleep_before_flash=data["flash"]["sleep_before_flash"],
-                                disable_flash=data["flash"]["disable_flash"])
+                                disable_flash=data["flash"]["disable_flash"],
+                                pulse_time=data["flash"]["pulse_time"])
+    boot.watch("flash", flashControl)
 
+    boot.begin("camera")
     cameraControl = CameraControl(flashControl, frame_rate=data["camera"]["frame_rate"],
                                   exposure_time=data["camera"]["exposure_time"],
                                   analogue_gain=data["camera"]["analogue_gain"],
@@ -825,51 +2749,72 @@ if __name__ == "__main__":
                                   horizontal_flip=data["camera"]["horizontal_flip"],
                                   print_fps=data["camera"]["print_fps"],
                                   show_preview=data["camera"]["show_preview"],
-                                  disable_camera=data["camera"]["disable_camera"])
-
-    main_window = MainWindow(cameraControl, flashControl, printerControl,
-                             size=data["main_window"]["size"],
-                             fps=data["main_window"]["fps"],
-                             home_file=data["main_window"]["home_file"],
-                             countdown_file=data["main_window"]["countdown_file"],
-                             top_text_size=data["main_window"]["top_text_size"],
-                             top_text_pos=data["main_window"]["top_text_pos"],
-                             bot_text_size=data["main_window"]["bot_text_size"],
-                             bot_text_pos=data["main_window"]["bot_text_pos"],
-                             frame_preview_size=data["main_window"]["frame_preview_size"],
-                             frame_preview_pos=data["main_window"]["frame_preview_pos"],
-                             frame_preview_timeout=data["main_window"]["frame_preview_timeout"],
-                             font=data["main_window"]["font"],
-                             font_size=data["main_window"]["font_size"],
-                             output_image_background_filename=data["main_window"]["output_image_background_filename"],
-                             print_background_filename=data["main_window"]["print_background_filename"],
-                             output_image_size=data["main_window"]["output_image_size"],
-                             print_image_size=data["main_window"]["print_image_size"],
-                             cropped_img_start=data["main_window"]["cropped_img_start"],
-                             cropped_img_end=data["main_window"]["cropped_img_end"],
-                             small_img_size=data["main_window"]["small_img_size"],
-                             small_img_1_pos=data["main_window"]["small_img_1_pos"],
-                             small_img_2_pos=data["main_window"]["small_img_2_pos"],
-                             small_img_3_pos=data["main_window"]["small_img_3_pos"],
-                             confirm_img_preview_size=data["main_window"]["confirm_img_preview_size"],
-                             confirm_img_preview_pos=data["main_window"]["confirm_img_preview_pos"],
-                             confirm_text_size=data["main_window"]["confirm_text_size"],
-                             confirm_text_pos=data["main_window"]["confirm_text_pos"],
-                             confirm_text_font_size=data["main_window"]["confirm_text_font_size"],
-                             default_how_many_prints=data["printer"]["default_how_many_prints"],
-                             max_prints=data["printer"]["max_prints"],
-                             print_confirm_timeout=data["main_window"]["print_confirm_timeout"],
-                             save_path=data["main_window"]["save_path"],
-                             increase_preview_brightness=data["main_window"]["increase_preview_brightness"],
-                             preview_contrast_value=data["main_window"]["preview_contrast_value"],
-                             preview_brightness_value=data["main_window"]["preview_brightness_value"],
-                             show_sleep_time=data["main_window"]["show_sleep_time"],
-                             disable_fullscreen=data["main_window"]["disable_fullscreen"],
-                             size_down_view=data["main_window"]["size_down_view"])
-    main_window.run()
-
-    flashControl.close()
-    printerControl.close()
-    cameraControl.close()
+                                  disable_camera=data["camera"]["disable_camera"],
+                                  idle_frame_rate=data["camera"]["idle_frame_rate"],
+                                  stop_when_idle=data["camera"]["stop_when_idle"],
+                                  flash_capture_timeout=data["camera"]["flash_capture_timeout"],
+                                  frame_ring_size=data["camera"]["frame_ring_size"],
+                                  zero_shutter_lag=data["camera"]["zero_shutter_lag"],
+                                  zero_shutter_lag_window=data["camera"]["zero_shutter_lag_window"],
+                                  setup_retry_interval=data["camera"]["setup_retry_interval"])
+    boot.watch("camera", cameraControl)
+
+    boot.begin("assets")
+    main_window = None
+    try:
+        main_window = MainWindow(cameraControl, flashControl, printerControl,
+                                 layout=layout,
+                                 fps=data["main_window"]["fps"],
+                                 home_file=data["main_window"]["home_file"],
+                                 countdown_file=data["main_window"]["countdown_file"],
+                                 frame_preview_timeout=data["main_window"]["frame_preview_timeout"],
+                                 font=data["main_window"]["font"],
+                                 font_size=data["main_window"]["font_size"],
+                                 output_image_background_filename=data["main_window"][
+                                     "output_image_background_filename"],
+                                 print_background_filename=data["main_window"]["print_background_filename"],
+                                 confirm_text_font_size=data["main_window"]["confirm_text_font_size"],
+                                 default_how_many_prints=data["printer"]["default_how_many_prints"],
+                                 max_prints=data["printer"]["max_prints"],
+                                 print_confirm_timeout=data["main_window"]["print_confirm_timeout"],
+                                 save_path=data["main_window"]["save_path"],
+                                 increase_preview_brightness=data["main_window"]["increase_preview_brightness"],
+                                 preview_contrast_value=data["main_window"]["preview_contrast_value"],
+                                 preview_brightness_value=data["main_window"]["preview_brightness_value"],
+                                 show_sleep_time=data["main_window"]["show_sleep_time"],
+                                 disable_fullscreen=data["main_window"]["disable_fullscreen"],
+                                 size_down_view=data["main_window"]["size_down_view"],
+                                 stream_videos=data["main_window"]["stream_videos"],
+                                 video_frame_budget=data["main_window"]["video_frame_budget"],
+                                 realtime_video=data["main_window"]["realtime_video"],
+                                 use_frame_cache=data["main_window"]["use_frame_cache"],
+                                 frame_cache_path=data["main_window"]["frame_cache_path"],
+                                 image_writer_threads=data["main_window"]["image_writer_threads"],
+                                 image_writer_queue_size=data["main_window"]["image_writer_queue_size"],
+                                 caption_cache_size=data["main_window"]["caption_cache_size"],
+                                 metrics_path=data["main_window"]["metrics_path"],
+                                 metrics_export_interval=data["main_window"]["metrics_export_interval"],
+                                 display=display,
+                                 idle_wait_millis=data["main_window"]["idle_wait_millis"],
+                                 post_process_workers=data["main_window"]["post_process_workers"],
+                                 photo_timeout=data["main_window"]["photo_timeout"],
+                                 printer_wait_timeout=data["main_window"]["printer_wait_timeout"],
+                                 session_catalog_path=data["main_window"]["session_catalog_path"],
+                                 thumbnail_sizes=data["main_window"]["thumbnail_sizes"],
+                                 thumbnail_quality=data["main_window"]["thumbnail_quality"])
+        boot.done("assets")
+        boot.start()
+
+        main_window.run()
+    finally:
+        # also after a failed startup, the shared memory of the camera and the workers is unlinked
+        if main_window is not None:
+            main_window.close()
+
+        flashControl.close()
+        printerControl.close()
+        cameraControl.close()
+        boot.close()
+        display.close()
 
     cv2.destroyAllWindows()
@@ -1,15 +1,189 @@
-import cups
 import argparse
+import glob
+import os
+import sys
+import time
+from collections import deque, Counter
+from cups_jobs import JobState, FINISHED_JOB_STATES, FakeConnection, get_job_attributes
+from session_catalog import SessionCatalog, parse_time
+
+
+class PrintJob:
+    def __init__(self, filename, copies):
+        self.filename = filename
+        self.copies = copies
+        self.job_id = None
+        self.state = None
+        self.sheets_completed = 0
+        self.start_time = None
+        self.end_time = None
+        self.error = ""
+
+
+# prints many files over one connection, at most max_jobs of them are queued in cups at the same time
+class BatchPrinter:
+    def __init__(self, conn, printer, max_jobs=2, poll_interval=0.5, wait_for_print=60, listener=None):
+        self.conn = conn
+        self.printer = printer
+        self.max_jobs = max(int(max_jobs), 1)
+        self.poll_interval = poll_interval
+        self.wait_for_print = wait_for_print
+        self.listener = listener
+
+    def submit(self, job):
+        job.start_time = time.monotonic()
+        try:
+            job.job_id = self.conn.printFile(self.printer, job.filename, "boothy",
+                                             {'fit-to-page': 'True', 'copies': str(job.copies)})
+            job.state = JobState.PENDING
+            print("Print job successfully created: ", job.filename, "copies:", job.copies, "id:", job.job_id)
+        except Exception as e:
+            job.error = str(e)
+            self.finish(job, JobState.ABORTED)
+
+    def poll(self, job):
+        try:
+            attributes = get_job_attributes(self.conn, job.job_id)
+            state = JobState(attributes["job-state"])
+            job.sheets_completed = min(int(attributes.get("job-media-sheets-completed", 0)), job.copies)
+
+            if state != job.state:
+                print("Print job", job.job_id, "state:", state.name)
+                job.state = state
+
+            if state in FINISHED_JOB_STATES:
+                self.finish(job, state)
+                return True
+        except Exception as e:
+            # e.g. cups purged the job or was restarted, the deadline below still applies
+            print("Print job state exception occurred: ", str(e))
+            state = job.state
+
+        if time.monotonic() - job.start_time > self.wait_for_print * job.copies:
+            job.error = "timeout"
+            print("Print job", job.job_id, "did not finish in", self.wait_for_print * job.copies, "s, cancelling it")
+            # a hanging job would block the printer queue and count against max_jobs
+            try:
+                self.conn.cancelJob(job.job_id)
+                state = JobState.CANCELED
+            except Exception as e:
+                print("Print job cancel exception occurred: ", str(e))
+            self.finish(job, state)
+            return True
+
+        return False
+
+    def finish(self, job, state):
+        job.state = state
+        job.end_time = time.monotonic()
+        if state == JobState.COMPLETED:
+            job.sheets_completed = job.copies
+        if self.listener is not None:
+            self.listener(job)
+
+    def run(self, jobs):
+        waiting = deque(jobs)
+        active = []
+
+        while waiting or active:
+            while waiting and len(active) < self.max_jobs:
+                job = waiting.popleft()
+                self.submit(job)
+                if job.end_time is None:
+                    active.append(job)
+
+            active = [job for job in active if not self.poll(job)]
+
+            if active:
+                time.sleep(self.poll_interval)
+
+        return jobs
+
+
+def get_catalog_files(catalog, recent, since, until):
+    if since or until:
+        rows = catalog.get_range(parse_time(since) if since else None, parse_time(until) if until else None)
+    else:
+        rows = reversed(catalog.get_recent(recent))
+    return [row["print_path"] for row in rows if row["status"] == "saved"]
+
+
+def print_summary(jobs, duration):
+    states = Counter(job.state.name if job.state is not None else "NOT_SENT" for job in jobs)
+    print("Printed files: ", len(jobs), "in {:.1f} s".format(duration))
+    for state, count in sorted(states.items()):
+        print("  {:<10} {}".format(state, count))
+    for job in jobs:
+        if job.state != JobState.COMPLETED:
+            print("  failed:", job.filename, job.state.name if job.state is not None else "", job.error)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Fotobudka',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-f', '--filename', help='Print filename', default='', type=str)
+    parser.add_argument('files', help='more files to print', nargs='*')
+    parser.add_argument('-g', '--glob', help='print every file matching this pattern, e.g. '
+                                             '"saved_images/*/*/print.png"', default='', type=str)
+    parser.add_argument('-d', '--database', help='session catalog to pick the files from', default='', type=str)
+    parser.add_argument('-r', '--recent', help='with --database, reprint the last sessions', default=1, type=int)
+    parser.add_argument('--since', help='with --database, sessions from, "YYYY-MM-DD HH:MM"', default='', type=str)
+    parser.add_argument('--until', help='with --database, sessions until, "YYYY-MM-DD HH:MM"', default='', type=str)
+    parser.add_argument('-n', '--copies', help='copies of every file', default=1, type=int)
+    parser.add_argument('-j', '--max-jobs', help='jobs queued in the printer at the same time', default=2, type=int)
+    parser.add_argument('--poll-interval', help='seconds between job state checks', default=0.5, type=float)
+    parser.add_argument('--wait-for-print', help='seconds per copy before a job is given up', default=60,
+                        type=float)
+    parser.add_argument('--fake', help='use a fake printer instead of cups', action='store_true')
+    parser.add_argument('--fake-print-time', help='seconds per copy of the fake printer', default=3.0, type=float)
     args = parser.parse_args()
 
-    conn = cups.Connection()
+    catalog = None
+    filenames = []
+    if args.filename:
+        filenames.append(args.filename)
+    filenames.extend(args.files)
+    if args.glob:
+        filenames.extend(sorted(glob.glob(args.glob)))
+    if args.database:
+        catalog = SessionCatalog(args.database, background=False)
+        filenames.extend(get_catalog_files(catalog, args.recent, args.since, args.until))
+
+    # a file given twice, e.g. by name and by the glob, is printed once, in the order it was first given
+    filenames = list(dict.fromkeys(filenames))
+    missing = [filename for filename in filenames if not os.path.isfile(filename)]
+    for filename in missing:
+        print("File does not exist: ", filename)
+    filenames = [filename for filename in filenames if filename not in missing]
+
+    if not filenames:
+        print("Nothing to print!")
+        exit(0)
+
+    if args.fake:
+        conn = FakeConnection(print_time=args.fake_print_time)
+    else:
+        import cups
+        conn = cups.Connection()
     printers = conn.getPrinters()
     default_printer = list(printers.keys())[0]
     print("Found printer: ", default_printer)
-    conn.printFile(default_printer, args.filename, "boothy", {'fit-to-page': 'True'})
-    print("Print job successfully created: ", args.filename)
+
+    if catalog is not None:
+        def listener(job):
+            catalog.add_printed(job.filename, job.sheets_completed, job.state.name)
+
+        for filename in filenames:
+            catalog.add_prints(filename, args.copies)
+    else:
+        listener = None
+
+    batch = BatchPrinter(conn, default_printer, args.max_jobs, args.poll_interval, args.wait_for_print, listener)
+    start = time.monotonic()
+    jobs = batch.run([PrintJob(filename, args.copies) for filename in filenames])
+    print_summary(jobs, time.monotonic() - start)
+
+    if catalog is not None:
+        catalog.close()
+
+    sys.exit(0 if all(job.state == JobState.COMPLETED for job in jobs) else 1)
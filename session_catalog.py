@@ -0,0 +1,211 @@
+import sqlite3
+import threading
+import time
+import os
+import argparse
+import traceback
+from queue import Queue, Empty
+from datetime import datetime
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session TEXT NOT NULL UNIQUE,
+    created REAL NOT NULL,
+    path TEXT NOT NULL,
+    print_path TEXT NOT NULL,
+    strip_path TEXT NOT NULL,
+    photo_1_path TEXT NOT NULL,
+    photo_2_path TEXT NOT NULL,
+    photo_3_path TEXT NOT NULL,
+    status TEXT NOT NULL,
+    print_count INTEGER NOT NULL DEFAULT 0,
+    printed_count INTEGER NOT NULL DEFAULT 0,
+    print_status TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS sessions_created ON sessions (created);
+CREATE INDEX IF NOT EXISTS sessions_print_path ON sessions (print_path);
+"""
+
+SESSION_FILES = ("print.png", "pasek.png", "1.png", "2.png", "3.png")
+
+
+def get_session_name(path):
+    # boot folder and session number, e.g. 2024_06_01_18_30_00/12
+    path = os.path.normpath(path)
+    return os.path.basename(os.path.dirname(path)) + "/" + os.path.basename(path)
+
+
+# sqlite index of the saved sessions, so reprints and stats do not have to walk the save folders on the sd card
+class SessionCatalog:
+    def __init__(self, db_path, background=True):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+
+        with self.lock:
+            # wal does not fsync on every commit, readers do not block the booth writing
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(SCHEMA)
+            self.conn.commit()
+
+        self.end = threading.Event()
+        self.write_queue = Queue()
+        self.background = background
+
+        # writes come from the image writer and printer threads, they only queue and never wait for the sd card
+        self.thread = None
+        if self.background:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.start()
+
+    def execute(self, sql, args=()):
+        if self.background:
+            self.write_queue.put((sql, args))
+        else:
+            self.write(sql, args)
+
+    def write(self, sql, args):
+        with self.lock:
+            self.conn.execute(sql, args)
+            self.conn.commit()
+
+    def run(self):
+        while not self.end.is_set() or not self.write_queue.empty():
+            try:
+                sql, args = self.write_queue.get(timeout=0.1)
+            except Empty:
+                continue
+
+            try:
+                self.write(sql, args)
+            except Exception as e:
+                print("Session catalog exception occurred: ", str(e))
+                traceback.print_exc()
+
+    def add_session(self, path, status, created=None, print_count=0):
+        if created is None:
+            created = time.time()
+        paths = [os.path.join(path, name) for name in SESSION_FILES]
+        self.execute("INSERT INTO sessions (session, created, path, print_path, strip_path, photo_1_path, "
+                     "photo_2_path, photo_3_path, status, print_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                     "ON CONFLICT (session) DO UPDATE SET status = excluded.status, "
+                     "print_count = print_count + excluded.print_count",
+                     (get_session_name(path), created, path, *paths, status, print_count))
+
+    def add_prints(self, print_path, count):
+        self.execute("UPDATE sessions SET print_count = print_count + ?, print_status = 'queued' "
+                     "WHERE print_path = ?", (count, print_path))
+
+    def add_printed(self, print_path, count, print_status):
+        self.execute("UPDATE sessions SET printed_count = printed_count + ?, print_status = ? WHERE print_path = ?",
+                     (count, print_status, print_path))
+
+    def query(self, sql, args=()):
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(sql, args).fetchall()]
+
+    def get_session(self, session):
+        rows = self.query("SELECT * FROM sessions WHERE session = ?", (session,))
+        return rows[0] if rows else None
+
+    def get_recent(self, limit=10):
+        return self.query("SELECT * FROM sessions ORDER BY created DESC LIMIT ?", (limit,))
+
+    def get_range(self, start=None, end=None):
+        if start is None:
+            start = 0.0
+        if end is None:
+            end = time.time()
+        return self.query("SELECT * FROM sessions WHERE created >= ? AND created < ? ORDER BY created",
+                          (start, end))
+
+    def get_stats(self, start=None, end=None):
+        if start is None:
+            start = 0.0
+        if end is None:
+            end = time.time()
+        rows = self.query("SELECT COUNT(*) AS sessions, "
+                          "COALESCE(SUM(status = 'saved'), 0) AS saved, "
+                          "COALESCE(SUM(status = 'failed'), 0) AS failed, "
+                          "COALESCE(SUM(print_count), 0) AS prints, "
+                          "COALESCE(SUM(printed_count), 0) AS printed, "
+                          "MIN(created) AS first, MAX(created) AS last "
+                          "FROM sessions WHERE created >= ? AND created < ?", (start, end))
+        return rows[0]
+
+    def scan(self, save_path):
+        # one time import of folders saved before the catalog existed, print counts are not known for those
+        known = set(row["session"] for row in self.query("SELECT session FROM sessions"))
+        added = 0
+        for boot_entry in sorted(os.scandir(save_path), key=lambda entry: entry.name):
+            if not boot_entry.is_dir():
+                continue
+            for session_entry in os.scandir(boot_entry.path):
+                if not session_entry.is_dir() or get_session_name(session_entry.path) in known:
+                    continue
+                print_path = os.path.join(session_entry.path, SESSION_FILES[0])
+                if not os.path.exists(print_path):
+                    continue
+                status = "saved" if all(os.path.exists(os.path.join(session_entry.path, name))
+                                        for name in SESSION_FILES) else "failed"
+                self.add_session(session_entry.path, status, os.path.getmtime(print_path))
+                added += 1
+        return added
+
+    def close(self):
+        self.end.set()
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            self.conn.close()
+
+
+def parse_time(value):
+    return datetime.strptime(value, "%Y-%m-%d %H:%M").timestamp()
+
+
+def format_session(row):
+    return "{:<24} {}  {:<7} prints {}/{} {:<10} {}".format(
+        row["session"], datetime.fromtimestamp(row["created"]).strftime("%Y-%m-%d %H:%M:%S"), row["status"],
+        row["printed_count"], row["print_count"], row["print_status"], row["print_path"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fotobudka session catalog',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-d', '--database', help='catalog file path', default='saved_images/sessions.db', type=str)
+    parser.add_argument('--scan', help='add sessions already saved under this folder', default='', type=str)
+    parser.add_argument('-r', '--recent', help='show the last sessions', default=10, type=int)
+    parser.add_argument('--since', help='show sessions from, "YYYY-MM-DD HH:MM"', default='', type=str)
+    parser.add_argument('--until', help='show sessions until, "YYYY-MM-DD HH:MM"', default='', type=str)
+    parser.add_argument('--stats', help='show session and print counts', action='store_true')
+    args = parser.parse_args()
+
+    catalog = SessionCatalog(args.database, background=False)
+
+    if args.scan:
+        print("Added sessions: ", catalog.scan(args.scan))
+
+    start = parse_time(args.since) if args.since else None
+    end = parse_time(args.until) if args.until else None
+
+    if args.stats:
+        stats = catalog.get_stats(start, end)
+        for key, value in stats.items():
+            if key in ("first", "last") and value is not None:
+                value = datetime.fromtimestamp(value).strftime("%Y-%m-%d %H:%M:%S")
+            print("{:<9} {}".format(key, value))
+    elif start is not None or end is not None:
+        for row in catalog.get_range(start, end):
+            print(format_session(row))
+    else:
+        for row in catalog.get_recent(args.recent):
+            print(format_session(row))
+
+    catalog.close()
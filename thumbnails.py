@@ -0,0 +1,131 @@
+import cv2
+import os
+import threading
+import argparse
+import traceback
+import time
+from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor
+from session_catalog import SESSION_FILES
+
+THUMBNAIL_FOLDER = "thumbs"
+
+
+def get_thumbnail_path(path, size):
+    # saved_images/<boot>/<session>/pasek.png -> saved_images/<boot>/<session>/thumbs/pasek_480.jpg
+    folder, name = os.path.split(path)
+    return os.path.join(folder, THUMBNAIL_FOLDER, os.path.splitext(name)[0] + "_" + str(size) + ".jpg")
+
+
+def make_thumbnails(path, sizes, quality=85, overwrite=False):
+    # sizes are the longer side in pixels, every level is scaled down from the previous one, not from the full image
+    sizes = sorted(sizes, reverse=True)
+    paths = [get_thumbnail_path(path, size) for size in sizes]
+    if not overwrite and all(os.path.exists(thumbnail_path) for thumbnail_path in paths):
+        return 0
+
+    image = cv2.imread(path)
+    if image is None:
+        print("Could not read image: ", path)
+        return 0
+
+    os.makedirs(os.path.dirname(paths[0]), exist_ok=True)
+    written = 0
+    for size, thumbnail_path in zip(sizes, paths):
+        scale = size / max(image.shape[:2])
+        if scale < 1:
+            image = cv2.resize(image, (max(round(image.shape[1] * scale), 1), max(round(image.shape[0] * scale), 1)),
+                               interpolation=cv2.INTER_AREA)
+        # written under a temporary name, a gallery never sees half a jpeg
+        tmp_path = thumbnail_path + ".tmp.jpg"
+        if cv2.imwrite(tmp_path, image, [cv2.IMWRITE_JPEG_QUALITY, int(quality)]):
+            os.replace(tmp_path, thumbnail_path)
+            written += 1
+        else:
+            print("Could not write thumbnail: ", thumbnail_path)
+    return written
+
+
+def make_session_thumbnails(session_path, sizes, quality=85, overwrite=False):
+    written = 0
+    for name in SESSION_FILES[1:]:
+        path = os.path.join(session_path, name)
+        if os.path.exists(path):
+            written += make_thumbnails(path, sizes, quality, overwrite)
+    return written
+
+
+def find_sessions(save_path):
+    sessions = []
+    for boot_entry in sorted(os.scandir(save_path), key=lambda entry: entry.name):
+        if not boot_entry.is_dir():
+            continue
+        for session_entry in os.scandir(boot_entry.path):
+            if session_entry.is_dir():
+                sessions.append(session_entry.path)
+    return sessions
+
+
+# makes the thumbnails of saved sessions in the background, one session at a time at the lowest priority
+class ThumbnailWriter:
+    def __init__(self, sizes, quality=85):
+        self.sizes = sizes
+        self.quality = quality
+        self.end = threading.Event()
+        self.session_queue = Queue()
+
+        thread = threading.Thread(target=self.run)
+        thread.start()
+
+        print("Thumbnail writer started!")
+
+    def add(self, session_path):
+        self.session_queue.put(session_path)
+
+    def run(self):
+        try:
+            # on linux this only lowers this thread, the ui and camera threads keep their priority
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+
+        while not self.end.is_set():
+            try:
+                session_path = self.session_queue.get(timeout=0.1)
+            except Empty:
+                continue
+
+            try:
+                make_session_thumbnails(session_path, self.sizes, self.quality)
+            except Exception as e:
+                print("Thumbnail writer exception occurred: ", str(e))
+                traceback.print_exc()
+
+    def close(self):
+        # sessions still waiting are left for the backfill
+        self.end.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fotobudka thumbnails',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('save_path', help='saved images folder to backfill', nargs='?', default='saved_images',
+                        type=str)
+    parser.add_argument('-s', '--sizes', help='longer side of every thumbnail level', default=[480, 160],
+                        nargs='+', type=int)
+    parser.add_argument('-q', '--quality', help='jpeg quality', default=85, type=int)
+    parser.add_argument('-j', '--workers', help='sessions processed at the same time', default=2, type=int)
+    parser.add_argument('--overwrite', help='make thumbnails that already exist again', action='store_true')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.save_path):
+        print("Folder does not exist: ", args.save_path)
+        exit(0)
+
+    sessions = find_sessions(args.save_path)
+    start = time.monotonic()
+    # cv2 releases the GIL while decoding and encoding, threads are enough
+    with ThreadPoolExecutor(max(args.workers, 1)) as executor:
+        written = sum(executor.map(lambda session: make_session_thumbnails(session, args.sizes, args.quality,
+                                                                           args.overwrite), sessions))
+    print("Sessions: ", len(sessions), "thumbnails written:", written, "in {:.1f} s".format(time.monotonic() - start))